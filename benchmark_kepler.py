@@ -0,0 +1,46 @@
+from __future__ import print_function
+from __future__ import division
+import time
+import numpy as np
+from EXOSIMS.util.eccanom import eccanom
+from plandb_kernels import keplerSolve
+
+#benchmark plandb_kernels.keplerSolve against EXOSIMS eccanom for mean anomalies
+#uniform in [0, 2pi) at fixed eccentricities in [0, 0.99], and for a mixed batch
+
+n = int(1e6)
+nrep = 3
+rng = np.random.RandomState(0)
+M = rng.uniform(0, 2*np.pi, n)
+
+def timeit(func):
+    """best wall time of nrep calls of func, and its output"""
+    best = np.inf
+    for j in range(nrep):
+        t = time.time()
+        res = func()
+        best = min(best, time.time() - t)
+    return best, res
+
+def residual(E, e):
+    return np.abs(M - (E - e*np.sin(E))).max()
+
+print("%8s %12s %12s %8s %12s %12s %12s"%('e','eccanom (s)','kepler (s)','speedup',
+                                          'eccanom res','kepler res','max |dE|'))
+cases = [(str(e), np.full(n, e)) for e in [0., 0.1, 0.3, 0.5, 0.7, 0.9, 0.95, 0.99]]
+cases.append(('U[0,.99]', rng.uniform(0, 0.99, n)))
+for label,e in cases:
+    t0, E0 = timeit(lambda: eccanom(M, e))
+    t1, E1 = timeit(lambda: keplerSolve(M, e))
+    print("%8s %12.4f %12.4f %8.1f %12.3e %12.3e %12.3e"%(label, t0, t1, t0/t1, residual(E0, e),
+                                                         residual(E1, e), np.abs(E1 - E0).max()))
+
+#with sin/cos(E) and true anomaly returned directly, into preallocated buffers
+e = cases[-1][1]
+bufs = tuple(np.empty(n) for j in range(4))
+t0, res = timeit(lambda: (lambda E: (E, 2*np.arctan(np.sqrt((1 + e)/(1 - e))*np.tan(E/2))))(eccanom(M, e)))
+t1, res = timeit(lambda: keplerSolve(M, e, out=bufs, sincos=True, trueanom=True))
+print("\nE and nu, mixed e: eccanom %.4f s, keplerSolve %.4f s"%(t0, t1))
+
+t1, res = timeit(lambda: keplerSolve(M.astype(np.float32), e.astype(np.float32)))
+print("float32, mixed e: keplerSolve %.4f s, max residual %.3e"%(t1, residual(res.astype(float), e)))
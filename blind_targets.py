@@ -9,6 +9,7 @@ import astropy.io
 import re
 import scipy.interpolate
 import astropy.constants as const
+from plandb_methods import spectralTypeLookup
 
 tmp = pandas.read_csv('blindsortedStars.txt')
 names = tmp['Name'].values 
@@ -49,7 +50,6 @@ catinds = np.hstack([np.where(cat.Name == n)[0] for n in names])
 mamajektable = astropy.io.ascii.read('EEM_dwarf_UBVIJHK_colors_Teff.txt',fill_values=[('...',np.nan),('....',np.nan),('.....',np.nan)])
 
 specregex = re.compile('([OBAFGKMLTY])(\d*\.\d+|\d+)V')
-specregex2 = re.compile('([OBAFGKMLTY])(\d*\.\d+|\d+).*')
 
 #grab spectral types from table
 MK = []
@@ -69,15 +69,9 @@ for l in 'OBAFGKM':
 #compute stellar radii
 specs = cat.Spec[catinds]
 specs[specs == 'APSREU(CR)'] = 'A7VpSrCrEu'
-radii = []
-for s in specs:
-    m = specregex2.match(s)
-    if m:
-        radii.append(Ri[m.groups()[0]](m.groups()[1]))
-    else:
-        radii.append(np.nan)
-        print(s)
-radii = np.array(radii)
+radii = spectralTypeLookup(specs, lambda l,n: Ri[l](n))
+for s in specs[np.isnan(radii)]:
+    print(s)
 
 dists = cat.dist[catinds]
 angrad = np.arctan((radii*const.R_sun)/dists).to('mas')
@@ -5,10 +5,19 @@ import getpass,keyring
 
 cache = True
 
+#date string of a previous cached run to update incrementally from (None for a full rebuild).
+#Only planets whose inputs changed since that run are recomputed.  Do a full rebuild
+#whenever the photometry, bands or completeness settings change.
+prevdate = None
+
+#radius error propagation: 'mc' (full Monte Carlo, use for releases) or 'delta'
+#(linearized with Monte Carlo only where that fails, for quick builds)
+errmode = 'mc'
+
 datestr = Time.now().datetime.strftime("%Y-%m-%d")
 
 #initial data dump
-data = getIPACdata()
+data = getIPACdata(errmode=errmode)
 
 #photometric data
 photdict = loadPhotometryData()
@@ -16,28 +25,73 @@ photdict = loadPhotometryData()
 #band info
 bandzip = list(genBands())
 
+#figure out what needs to be recomputed
+if prevdate is None:
+    prevdata = prevorbdata = prevaltorbdata = prevcomps = prevaliases = None
+else:
+    prevdata = pandas.read_pickle('data_'+prevdate+'.pkl')
+    prevorbdata = pandas.read_pickle('orbdata_'+prevdate+'.pkl')
+    prevaltorbdata = pandas.read_pickle('altorbdata_'+prevdate+'.pkl')
+    prevcomps = pandas.read_pickle('completeness_'+prevdate+'.pkl')
+    prevaliases = pandas.read_pickle('aliases_'+prevdate+'.pkl')
+changed = findChangedPlanets(data, prevdata)
+keepnames = data['pl_name'].values[~changed]
+print("%d of %d planets are new or changed."%(changed.sum(), len(changed)))
+newdata = data[changed].reset_index(drop=True)
+
 #calculate quadrature columns:
-data = calcQuadratureVals(data, bandzip, photdict)
-if cache: data.to_pickle('data_'+datestr+'.pkl')
+if len(newdata) > 0:
+    #host star and planet parameters shared by all of the stages below
+    params = PlanetParams(newdata, stars=genStarTable(newdata, photdict))
+    newdata = calcQuadratureVals(newdata, bandzip, photdict, params=params)
 
 #get orbital data
-orbdata = genOrbitData(data,bandzip,photdict)
+orbdata = genOrbitData(newdata,bandzip,photdict,params=params) if len(newdata) > 0 else None
+orbdata = mergeCachedRows(orbdata, prevorbdata, keepnames)
 if cache: orbdata.to_pickle('orbdata_'+datestr+'.pkl')
 
-altorbdata =genAltOrbitData(data, bandzip, photdict)
+altorbdata = genAltOrbitData(newdata, bandzip, photdict, params=params) if len(newdata) > 0 else None
+altorbdata = mergeCachedRows(altorbdata, prevaltorbdata, keepnames)
 if cache: altorbdata.to_pickle('altorbdata_'+datestr+'.pkl')
 
 
 #completeness
-comps,compdict,data = calcPlanetCompleteness(data, bandzip, photdict)
+comps = None
+if len(newdata) > 0:
+    comps,compdict,newdata = calcPlanetCompleteness(newdata, bandzip, photdict, params=params)
+comps = mergeCachedRows(comps, prevcomps, keepnames)
+
+if prevdata is None:
+    data = newdata
+else:
+    data = mergeCachedPlanets(data, changed, newdata, prevdata)
+
+goodinds = np.where(~np.isnan(data['completeness'].values))[0]
+compdict = {'cs':data['completeness'].values[goodinds],
+            'goodinds':goodinds,
+            'minCWA':data['compMinWA'].values[goodinds],
+            'maxCWA':data['compMaxWA'].values[goodinds],
+            'minCdMag':data['compMindMag'].values[goodinds],
+            'maxCdMag':data['compMaxdMag'].values[goodinds]}
 if cache: 
     comps.to_pickle('completeness_'+datestr+'.pkl')
     np.savez('completeness_'+datestr,**compdict)
     data.to_pickle('data_'+datestr+'.pkl')
 
 
-#aliases
-aliases = genAliases(data)
+#aliases (only look up host stars we haven't seen before)
+if prevaliases is None:
+    aliases = genAllAliases(data)
+else:
+    hosts = data['pl_hostname'].unique()
+    prevhosts = prevaliases.loc[prevaliases['NEAName'] == 1, ['SID','Alias']]
+    prevhosts = prevhosts[prevhosts['Alias'].isin(hosts)]
+    aliases = prevaliases[prevaliases['SID'].isin(prevhosts['SID'].values)]
+    newhosts = list(set(hosts) - set(prevhosts['Alias'].values))
+    if len(newhosts) > 0:
+        newaliases = genAliases(newhosts)
+        newaliases['SID'] += (aliases['SID'].max() + 1) if len(aliases) > 0 else 0
+        aliases = pandas.concat([aliases, newaliases], ignore_index=True)
 if cache: aliases.to_pickle('aliases_'+datestr+'.pkl')
 
 
@@ -1,6 +1,4 @@
-import requests
 import pandas
-from StringIO import StringIO
 import pickle
 import astropy.units as u
 import astropy.constants as const
@@ -9,12 +7,12 @@ from sqlalchemy import create_engine
 import getpass,keyring
 import numpy as np
 import re
+from plandb_methods import readIPACquery
 
 
-def substitute_data(original_data):
+def substitute_data(original_data, cachedir=None, offline=False):
     query_ext = """https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI?table=exomultpars&select=*&format=csv"""
-    r_ext = requests.get(query_ext)
-    data_ext = pandas.read_csv(StringIO(r_ext.content))
+    data_ext = readIPACquery(query_ext, cachedir=cachedir, offline=offline)
 
     # planets_of_int = pandas.read_csv("C:\\Users\\NathanelKinzly\\github\\orbits\\plandb.sioslab.com\\output.csv")
     # names = planets_of_int[["pl_name"]]
@@ -0,0 +1,289 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import astropy.units as u
+
+#unit conversions, evaluated once
+AU_PER_PC = (1*u.AU/u.pc).decompose().value
+MAS_PER_RAD = (1*u.rad).to(u.mas).value
+DEG_PER_RAD = (1*u.rad).to(u.deg).value
+RJUP_PER_AU = (1*u.R_jupiter/u.AU).decompose().value
+
+
+def outBuffer(out, dtype, *args):
+    """
+    Output array for a kernel evaluated on args.  If out is given it is returned as
+    is, otherwise a new array of the broadcast shape of args is allocated with
+    dtype (default: float32 if there are array inputs and all of them are float32,
+    float64 otherwise).
+    """
+
+    if out is not None:
+        return out
+    if dtype is None:
+        arrs = [a for a in args if np.ndim(a) > 0]
+        if (len(arrs) > 0) and all(np.asarray(a).dtype == np.float32 for a in arrs):
+            dtype = np.float32
+        else:
+            dtype = np.float64
+
+    return np.empty(np.broadcast(*args).shape, dtype=dtype)
+
+
+def projectedSeparation(d, I, nu, w, out=None, dtype=None):
+    """
+    Projected separation of planet at orbital radius d, with inclination I, true
+    anomaly nu and argument of periapsis w (all angles in radians):
+    s = d*sqrt(1 - sin^2(I)sin^2(nu + w)).  Units of s are those of d.
+    """
+
+    out = outBuffer(out, dtype, d, I, nu, w)
+    np.add(nu, w, out=out)
+    np.sin(out, out=out)
+    np.multiply(out, np.sin(I), out=out)
+    #(1 - x)(1 + x) rather than 1 - x^2 to avoid cancellation near s = 0
+    tmp = np.subtract(1., out)
+    np.add(out, 1., out=out)
+    np.multiply(out, tmp, out=out)
+    np.sqrt(out, out=out)
+    np.multiply(out, d, out=out)
+
+    return out
+
+
+def phaseAngle(I, nu, w, deg=False, out=None, dtype=None):
+    """
+    Star-planet-observer angle beta = arccos(-sin(I)sin(nu + w)) for inclination I,
+    true anomaly nu and argument of periapsis w (radians).  Returns radians, or
+    degrees if deg is True.
+    """
+
+    out = outBuffer(out, dtype, I, nu, w)
+    np.add(nu, w, out=out)
+    np.sin(out, out=out)
+    np.multiply(out, np.negative(np.sin(I)), out=out)
+    np.arccos(out, out=out)
+    if deg:
+        np.multiply(out, DEG_PER_RAD, out=out)
+
+    return out
+
+
+def workingAngle(s, dist, out=None, dtype=None):
+    """
+    Angular separation (mas) of projected separation s (AU) at distance dist (pc)
+    """
+
+    out = outBuffer(out, dtype, s, dist)
+    np.divide(s, dist, out=out)
+    np.multiply(out, AU_PER_PC, out=out)
+    np.arctan(out, out=out)
+    np.multiply(out, MAS_PER_RAD, out=out)
+
+    return out
+
+
+def deltaMagnitude(Rp, d, pphi, p=1., out=None, dtype=None):
+    """
+    Planet-star difference in magnitude for planet radius Rp (R_jupiter) at orbital
+    radius d (AU) with albedo times phase function pphi (scaled by p).  Zero
+    pphi gives inf and negative pphi gives NaN.
+    """
+
+    out = outBuffer(out, dtype, Rp, d, pphi)
+    np.divide(Rp, d, out=out)
+    np.multiply(out, RJUP_PER_AU, out=out)
+    np.square(out, out=out)
+    np.multiply(out, pphi, out=out)
+    if p != 1.:
+        np.multiply(out, p, out=out)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log10(out, out=out)
+    np.multiply(out, -2.5, out=out)
+
+    return out
+
+
+def keplerSolve(M, e, out=None, dtype=None, tol=None, maxiter=4, sincos=False, trueanom=False):
+    """
+    Eccentric anomaly E solving Kepler's equation M = E - e*sin(E) for mean
+    anomalies M (radians) and eccentricities 0 <= e < 1 of any mutually
+    broadcastable shapes (scalars give scalars).
+
+    Uses Markley's (1995) starter, accurate to ~1e-3 at any e, and his fifth order
+    correction, for a total of one sin and one cos evaluation per element.  Up to
+    maxiter Newton iterations are then applied where the residual
+    |M - E + e*sin(E)| (for M reduced to [-pi, pi]) still exceeds tol (default:
+    4.01 machine epsilons of dtype).  Raises ValueError if this fails.  E is in
+    the same 2*pi branch as M.
+
+    If sincos is True sin(E) and cos(E) are also returned, and if trueanom is True
+    the true anomaly is returned as well, in that order.  out is an output array
+    for E or a tuple of output arrays for all returned values.
+    """
+
+    nout = 1 + 2*sincos + trueanom
+    outs = out if isinstance(out, tuple) else (out,) + (None,)*(nout - 1)
+    if len(outs) != nout:
+        raise ValueError("out must have one array per returned value.")
+    E = outBuffer(outs[0], dtype, M, e)
+    dtype = E.dtype
+    #scalars are worked on as 1 element arrays
+    M, e = np.broadcast_arrays(np.atleast_1d(np.asarray(M, dtype=dtype)),
+                               np.atleast_1d(np.asarray(e, dtype=dtype)))
+    if np.any((e < 0) | (e >= 1)):
+        raise ValueError("Eccentricities must be in [0,1).")
+    if tol is None:
+        tol = 4.01*np.finfo(dtype).eps
+
+    #reduce to 0 <= Mr <= pi using E(-M) = -E(M) and 2*pi periodicity
+    twopi = dtype.type(2*np.pi)
+    k = np.round(M/twopi)
+    Mr = M - k*twopi
+    sgn = np.sign(Mr)
+    sgn[sgn == 0] = 1
+    np.abs(Mr, out=Mr)
+
+    #Markley starter
+    pi = dtype.type(np.pi)
+    alpha = (pi - Mr)/(1 + e)
+    alpha *= dtype.type(1.6*np.pi/(np.pi**2 - 6))
+    alpha += dtype.type(3*np.pi**2/(np.pi**2 - 6))
+    d = alpha*e
+    d += 3*(1 - e)
+    Mr2 = Mr**2
+    q = 2*alpha*d*(1 - e) - Mr2
+    r = (3*alpha*d*(d - 1 + e) + Mr2)*Mr
+    w = q**3
+    w += r**2
+    np.maximum(w, 0, out=w)
+    np.sqrt(w, out=w)
+    w += np.abs(r)
+    np.cbrt(w, out=w)
+    w *= w
+    Er = 2*r*w
+    Er /= w**2 + w*q + q**2
+    Er += Mr
+    Er /= d
+
+    #fifth order correction
+    sinEr = np.sin(Er)
+    cosEr = np.cos(Er)
+    esin = e*sinEr
+    ecos = e*cosEr
+    f0 = Er - esin - Mr
+    f1 = 1 - ecos
+    esin *= 0.5
+    ecos /= 6
+    d3 = -f0/(f1 - f0*esin/f1)
+    d4 = -f0/(f1 + d3*(esin + d3*ecos))
+    d5 = -f0/(f1 + d4*(esin + d4*(ecos - d4*esin/12)))
+    Er += d5
+
+    #the correction is < 1e-3, so sin/cos(Er) follow from angle addition with
+    #Taylor series in d5 (exact to roundoff) rather than new trig calls
+    d2 = d5**2
+    cosd = 1 - 0.5*d2*(1 - d2/12)
+    sind = d5*(1 - d2/6*(1 - d2/20))
+    esin = sinEr*cosd + cosEr*sind
+    cosEr = cosEr*cosd - sinEr*sind
+    sinEr = esin
+    big = np.abs(d5) > 1e-2
+    if np.any(big):
+        sinEr[big] = np.sin(Er[big])
+        cosEr[big] = np.cos(Er[big])
+
+    #Newton polish of any elements still above tolerance
+    for it in range(maxiter + 1):
+        f0 = Er - e*sinEr - Mr
+        bad = np.abs(f0) > tol
+        if not np.any(bad):
+            break
+        if it == maxiter:
+            raise ValueError("keplerSolve failed to converge.  Max residual %e."%np.abs(f0).max())
+        Er[bad] -= f0[bad]/(1 - e[bad]*cosEr[bad])
+        sinEr[bad] = np.sin(Er[bad])
+        cosEr[bad] = np.cos(Er[bad])
+
+    #outputs are filled through 1 element views if scalar
+    view = np.atleast_1d
+    np.multiply(k, twopi, out=view(E))
+    view(E)[...] += sgn*Er
+
+    res = [E]
+    if sincos or trueanom:
+        sinE = outBuffer(outs[1] if sincos else None, dtype, E)
+        np.multiply(sgn, sinEr, out=view(sinE))
+        cosE = outBuffer(outs[2] if sincos else None, dtype, E)
+        view(cosE)[...] = cosEr
+        if sincos:
+            res += [sinE, cosE]
+        if trueanom:
+            nu = outBuffer(outs[-1], dtype, E)
+            np.arctan2(np.sqrt(1 - e**2)*view(sinE), view(cosE) - e, out=view(nu))
+            res.append(nu)
+
+    #scalar inputs give scalar outputs (unless output arrays were given), as for ufuncs
+    if np.ndim(E) == 0:
+        res = [r if o is not None else r[()] for r,o in zip(res, outs)]
+
+    return res[0] if len(res) == 1 else tuple(res)
+
+
+def orbitVectors(a, e, I, w):
+    """
+    Vectors A and B, each of shape (3,) + the broadcast shape of the inputs, for
+    semi-major axis a, eccentricity e, inclination I and argument of periapsis w
+    (radians), such that the planet position at eccentric anomaly E is
+    r = A(cos(E) - e) + B sin(E), in units of a, with the observer along +z.
+    These only depend on the orbit, so can be reused for any set of times.
+    """
+
+    a, e, I, w = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (a, e, I, w)])
+    sinw = np.sin(w)
+    cosw = np.cos(w)
+    sinI = np.sin(I)
+    cosI = np.cos(I)
+    b = a*np.sqrt(1 - e**2)
+    A = np.stack((a*cosw, a*cosI*sinw, a*sinI*sinw))
+    B = np.stack((-b*sinw, b*cosI*cosw, b*sinI*cosw))
+
+    return A, B
+
+
+def orbitPosition(A, B, e, sinE, cosE, out=None, dtype=None):
+    """
+    Planet position r = A(cos(E) - e) + B sin(E), of shape (3,) + the broadcast
+    shape of A[0], B[0], e, sinE and cosE, for orbitVectors A, B.
+    """
+
+    X = np.subtract(cosE, e)
+    A = np.asarray(A)
+    B = np.asarray(B)
+    shape = np.broadcast(A[0], B[0], X, sinE).shape
+    #align the trailing axes of A and B with those of the broadcast shape
+    A = A.reshape((3,) + (1,)*(len(shape) - A.ndim + 1) + A.shape[1:])
+    B = B.reshape((3,) + (1,)*(len(shape) - B.ndim + 1) + B.shape[1:])
+    out = outBuffer(out, dtype, A, B, X[None], np.asarray(sinE)[None])
+    np.multiply(A, X, out=out)
+    out += B*sinE
+
+    return out
+
+
+def phaseAngleFromPosition(z, d, deg=False, out=None, dtype=None):
+    """
+    Star-planet-observer angle beta = arccos(-z/d) of a planet at orbital radius d
+    with line of sight coordinate z (observer along +z).  Returns radians, or
+    degrees if deg is True.
+    """
+
+    out = outBuffer(out, dtype, z, d)
+    np.divide(z, d, out=out)
+    np.negative(out, out=out)
+    np.clip(out, -1., 1., out=out)
+    np.arccos(out, out=out)
+    if deg:
+        np.multiply(out, DEG_PER_RAD, out=out)
+
+    return out
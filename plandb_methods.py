@@ -3,36 +3,45 @@ from __future__ import division
 import requests
 import pandas
 try:
-    from StringIO import StringIO
+    from urllib import urlencode
 except ImportError:
-    from io import BytesIO as StringIO
+    from urllib.parse import urlencode
 import astropy.units as u
 import astropy.constants as const
 import EXOSIMS.PlanetPhysicalModel.Forecaster
 import numpy as np
-from scipy.interpolate import interp1d, interp2d, RectBivariateSpline, griddata
+import scipy
+from scipy.interpolate import interp1d, interp2d, RectBivariateSpline, RegularGridInterpolator
 from astropy.time import Time
 import sqlalchemy.types
 from sqlalchemy import create_engine
 import re
 import os
-from EXOSIMS.util.deltaMag import deltaMag
-from EXOSIMS.util.eccanom import eccanom
+import sqlite3
+import csv
+import collections
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from plandb_kernels import projectedSeparation, phaseAngle, workingAngle, deltaMagnitude, keplerSolve, \
+    orbitVectors, orbitPosition, phaseAngleFromPosition
 from astroquery.simbad import Simbad
 from requests.exceptions import ConnectionError
 import math
 from MeanStars import MeanStars
 
 
-def RfromM(m):
+def RfromMcoeffs():
     '''
-    Given masses m (in Earth masses) return radii (in Earth radii) \
-    based on modified forecaster
+    Return the slopes S, intercepts C (log10 space) and mass breakpoints T (in
+    Earth masses) of the piecewise power law used by the modified forecaster
 
     '''
-    m = np.array(m,ndmin=1)
-    R = np.zeros(m.shape)
-
 
     S = np.array([0.2790,0,0,0,0.881])
     C = np.array([np.log10(1.008), 0, 0, 0, 0])
@@ -51,6 +60,19 @@ def RfromM(m):
 
     C[4] = np.log10(Rj) - np.log10(T[3])*S[4]
 
+    return S, C, T
+
+
+def RfromM(m):
+    '''
+    Given masses m (in Earth masses) return radii (in Earth radii) \
+    based on modified forecaster
+
+    '''
+    m = np.array(m,ndmin=1)
+    R = np.zeros(m.shape)
+
+    S, C, T = RfromMcoeffs()
 
     inds = np.digitize(m,np.hstack((0,T,np.inf)))
     for j in range(1,inds.max()+1):
@@ -59,21 +81,628 @@ def RfromM(m):
     return R
 
 
+def dRdM(m):
+    '''
+    Derivative of RfromM (Earth radii per Earth mass) at masses m (in Earth masses)
+
+    '''
+    m = np.array(m,ndmin=1,dtype=float)
+    S, C, T = RfromMcoeffs()
+    inds = np.digitize(m,np.hstack((0,T,np.inf)))
+    dR = np.zeros(m.shape)
+    for j in range(1,inds.max()+1):
+        dR[inds == j] = S[j-1]*10.**(C[j-1] + np.log10(m[inds == j])*(S[j-1] - 1))
+
+    return dR
+
+
+def genFortneyRadius(fortney=None):
+    '''
+    Build a vectorized evaluator of the Fortney et al. (2007) mass-radius relation
+    as used for planets without a measured radius: the rock/ice relation (ice
+    fraction 0.67) up to 17 Earth masses and the 10 Gyr giant planet grid above that,
+    with sma and mass clipped to the grid limits.
+
+    The giant planet interpolant is built once here, so the returned function takes
+    arrays of masses (Earth masses) and smas (AU) of any matching shape and returns
+    radii (Earth radii) in a single call.  Its breaks attribute lists the mass and
+    sma values where the relation is not smooth (see linearUncertainty).
+    '''
+
+    if fortney is None:
+        from EXOSIMS.PlanetPhysicalModel.FortneyMarleyCahoyMix1 import FortneyMarleyCahoyMix1
+        fortney = FortneyMarleyCahoyMix1()
+
+    #the relation is only ever evaluated at 10 Gyr, which is one of the grid ages, so
+    #interpolate (bilinearly) on that slice of the grid.  The 3-D triangulation used by
+    #griddata has sliver simplices on that plane that make its values depend on which
+    #other points are evaluated in the same call.
+    pts = fortney.giant_pts2[fortney.giant_pts2[:,0] == 10.]
+    vals = fortney.giant_vals2[fortney.giant_pts2[:,0] == 10.]
+    anodes = np.unique(pts[:,1])
+    mnodes = np.unique(pts[:,2])
+    grid = np.zeros((anodes.size, mnodes.size))
+    grid[np.searchsorted(anodes, pts[:,1]), np.searchsorted(mnodes, pts[:,2])] = vals
+    giantinterp = RegularGridInterpolator((anodes, mnodes), grid)
+    amin = anodes.min()
+    amax = anodes.max()
+    mmax = mnodes.max()
+
+    def Rf(m, a):
+        m = np.array(m, ndmin=1, dtype=float)
+        a = np.broadcast_to(a, m.shape)
+        R = np.zeros(m.shape)
+
+        ml = m <= 17
+        R[ml] = fortney.R_ri(0.67, m[ml])
+
+        mg = m > 17
+        R[mg] = giantinterp(np.vstack((np.clip(a[mg], amin, amax), np.minimum(m[mg], mmax))).T)
+        return R
+
+    #mass and sma values where the relation switches models or hits the grid edges
+    Rf.breaks = [np.array([17., mmax]), np.array([amin, amax])]
+
+    return Rf
+
+
+def truncnormSample(mu, sigma, nsamp, lower=0., rng=None, maxiter=100):
+    '''
+    Draw nsamp samples for each (mu, sigma) pair from a normal distribution
+    truncated below at lower, returning a (len(mu) x nsamp) array.
+
+    Draws falling below lower are redrawn in bulk until none remain.  Anything still
+    left after maxiter passes (means far below lower) is drawn directly from the
+    inverse CDF of the truncated distribution.
+    '''
+
+    if rng is None:
+        rng = np.random
+    mu = np.array(mu, ndmin=1, dtype=float)[:,None]
+    sigma = np.array(sigma, ndmin=1, dtype=float)[:,None]
+
+    out = rng.normal(size=(mu.size, nsamp))*sigma + mu
+    bad = out < lower
+    for _ in range(maxiter):
+        if not bad.any():
+            return out
+        rows = np.where(bad)[0]
+        out[bad] = rng.normal(size=rows.size)*sigma[rows,0] + mu[rows,0]
+        bad = out < lower
+
+    rows = np.where(bad)[0]
+    if rows.size > 0:
+        from scipy.stats import truncnorm
+        sig = sigma[rows,0]
+        zero = sig <= 0
+        sig[zero] = 1.
+        vals = truncnorm.ppf(rng.uniform(size=rows.size), (lower - mu[rows,0])/sig, np.inf,
+                             loc=mu[rows,0], scale=sig)
+        vals[zero] = lower
+        out[bad] = vals
+
+    return out
+
+
+def propagateUncertainty(func, mus, sigmas, nsamp=int(1e4), percentiles=(15.865,84.135),
+                         maxsamples=2**24, seed=None, lower=None):
+    '''
+    Monte Carlo propagation of normally distributed input errors through a
+    vectorized model function.
+
+    mus and sigmas are lists with one array (of length nplanets) per model input.
+    Samples are drawn as (planets x nsamp) blocks for all inputs and passed to
+    func, which must return an array of the same shape.  Planets are processed in
+    chunks holding at most maxsamples samples per input.  Planets with a NaN mean or
+    error in any input get NaN outputs.  lower optionally gives a lower bound for
+    each input (None for unbounded), in which case that input is drawn from a
+    truncated normal (see truncnormSample).  Setting seed (an int or a
+    numpy RandomState) makes the draws reproducible (otherwise the global numpy
+    random state is used).
+
+    Returns a dict with the standard deviation ('std') of the model output for each
+    planet along with each of the requested percentiles (keyed by value).
+    '''
+
+    mus = [np.array(mu, ndmin=1, dtype=float) for mu in mus]
+    sigmas = [np.array(sig, ndmin=1, dtype=float) for sig in sigmas]
+    if lower is None:
+        lower = [None]*len(mus)
+    nplan = mus[0].size
+    if seed is None:
+        rng = np.random
+    elif isinstance(seed, np.random.RandomState):
+        rng = seed
+    else:
+        rng = np.random.RandomState(seed)
+
+    out = {'std': np.full(nplan, np.nan)}
+    for p in percentiles:
+        out[p] = np.full(nplan, np.nan)
+
+    valid = np.ones(nplan, dtype=bool)
+    for mu,sig in zip(mus,sigmas):
+        valid &= np.isfinite(mu) & np.isfinite(sig)
+    inds = np.where(valid)[0]
+
+    chunk = max(1, int(maxsamples // nsamp))
+    for j in range(0, inds.size, chunk):
+        cinds = inds[j:j+chunk]
+        samps = []
+        for mu,sig,lo in zip(mus,sigmas,lower):
+            if lo is None:
+                samps.append(rng.normal(size=(cinds.size, nsamp))*sig[cinds,None] + mu[cinds,None])
+            else:
+                samps.append(truncnormSample(mu[cinds], sig[cinds], nsamp, lower=lo, rng=rng))
+        vals = func(*samps)
+        out['std'][cinds] = vals.std(axis=1)
+        if len(percentiles) > 0:
+            pvals = np.percentile(vals, percentiles, axis=1)
+            for p,pv in zip(percentiles,pvals):
+                out[p][cinds] = pv
+
+    return out
+
+
+def linearUncertainty(func, mus, sigmas, derivs=None, breaks=None, lower=None, nsig=3.,
+                      maxrelerr=0.25, nvalidate=0, seed=None, nsamp=int(1e4)):
+    '''
+    Fast first order (delta method) alternative to propagateUncertainty.
+
+    The output standard deviation is sqrt(sum_i (df/dx_i sigma_i)^2), with the
+    partial derivatives given by the list of callables derivs (same signature as
+    func, None entries for inputs without one).  Missing derivatives are taken as
+    central differences over +/- one sigma (clipped at the input's lower bound).
+
+    Linearization fails near kinks and jumps in func and for large errors, so
+    planets whose +/- nsig sigma interval in any input contains one of that input's
+    breaks, or whose relative error in any input exceeds maxrelerr, are handed to
+    propagateUncertainty instead.  If nvalidate > 0, up to that many linearized
+    planets are also run through Monte Carlo to measure the deviation.
+
+    Returns a dict with the standard deviations ('std'), a boolean mask of the
+    planets done by Monte Carlo ('mc') and the relative deviations from Monte Carlo
+    of the validation planets ('deviation', empty if nvalidate is 0).
+    '''
+
+    mus = [np.array(mu, ndmin=1, dtype=float) for mu in mus]
+    sigmas = [np.array(sig, ndmin=1, dtype=float) for sig in sigmas]
+    nin = len(mus)
+    if derivs is None:
+        derivs = [None]*nin
+    if breaks is None:
+        breaks = [None]*nin
+    if lower is None:
+        lower = [None]*nin
+    nplan = mus[0].size
+    if seed is None or isinstance(seed, np.random.RandomState):
+        rng = seed
+    else:
+        rng = np.random.RandomState(seed)
+
+    valid = np.ones(nplan, dtype=bool)
+    for mu,sig in zip(mus,sigmas):
+        valid &= np.isfinite(mu) & np.isfinite(sig)
+
+    #find planets where linearization can't be trusted
+    mc = np.zeros(nplan, dtype=bool)
+    for mu,sig,br in zip(mus,sigmas,breaks):
+        mc |= sig > maxrelerr*np.abs(mu)
+        if br is not None:
+            for b in br:
+                mc |= np.abs(mu - b) <= nsig*sig
+    mc &= valid
+
+    var = np.zeros(nplan)
+    lin = np.where(valid & ~mc)[0]
+    #nothing to linearize (e.g. all errors above maxrelerr): all Monte Carlo
+    for j in range(nin if lin.size > 0 else 0):
+        sig = sigmas[j][lin]
+        if derivs[j] is not None:
+            df = derivs[j](*[mu[lin] for mu in mus])
+        else:
+            hi = mus[j][lin] + sig
+            lo = mus[j][lin] - sig
+            if lower[j] is not None:
+                lo = np.maximum(lo, lower[j])
+            xhi = [mu[lin] for mu in mus]
+            xlo = [mu[lin] for mu in mus]
+            xhi[j] = hi
+            xlo[j] = lo
+            span = hi - lo
+            df = np.zeros(lin.size)
+            ok = span > 0
+            df[ok] = ((func(*xhi) - func(*xlo))[ok])/span[ok]
+        var[lin] += (df*sig)**2
+
+    out = {'std': np.full(nplan, np.nan), 'mc': mc}
+    out['std'][lin] = np.sqrt(var[lin])
+
+    if mc.any():
+        mcinds = np.where(mc)[0]
+        out['std'][mcinds] = propagateUncertainty(func, [mu[mcinds] for mu in mus],
+                [sig[mcinds] for sig in sigmas], nsamp=nsamp, percentiles=(),
+                seed=rng, lower=lower)['std']
+
+    out['deviation'] = np.array([])
+    if (nvalidate > 0) and (lin.size > 0):
+        vinds = lin if lin.size <= nvalidate else \
+            np.sort((np.random if rng is None else rng).choice(lin, nvalidate, replace=False))
+        mcstd = propagateUncertainty(func, [mu[vinds] for mu in mus],
+                [sig[vinds] for sig in sigmas], nsamp=nsamp, percentiles=(),
+                seed=rng, lower=lower)['std']
+        #floor the scale at roundoff level of the model value, where both are ~0
+        scale = np.maximum(mcstd, 1e-8*np.abs(func(*[mu[vinds] for mu in mus])))
+        ok = scale > 0
+        out['deviation'] = np.abs(out['std'][vinds][ok] - mcstd[ok])/scale[ok]
+
+    return out
+
+
+def reportLinearUncertainty(label, res):
+    '''
+    Print a summary of a linearUncertainty result
+
+    '''
+
+    dev = res['deviation']
+    nlin = (np.isfinite(res['std']) & ~res['mc']).sum()
+    msg = "%s errors: %d of %d planets linearized."%(label, nlin, res['mc'].size)
+    if dev.size > 0:
+        msg += " Relative deviation from Monte Carlo (%d planets): median %.3g, 90th percentile %.3g, max %.3g."%(
+            dev.size, np.median(dev), np.percentile(dev, 90), dev.max())
+    print(msg)
+
+
+def chooseBestAttributes(extended, plnames):
+    '''
+    Flag the best row of the extended (exomultpars) table for each planet in plnames.
+
+    Rows are ranked by how complete their orbital information is (good_lvl 0-4) and,
+    within a level, by publication year (newest first).  If the newest row for a planet
+    lacks the basic sma/period and mass/radius info, the first row that has it is
+    promoted to level 1.  Planets with no usable rows fall back on their newest row.
+
+    Returns an array of 0/1 flags matching the rows of extended.
+    '''
+
+    has = {col: extended[col].notnull().values for col in
+           ['mpl_orbsmax', 'mpl_orbper', 'mpl_bmassj', 'mpl_radj', 'mpl_orbeccen',
+            'mpl_orbtper', 'mpl_orblper', 'mpl_orbincl']}
+    base_need = (has['mpl_orbsmax'] | has['mpl_orbper']) & (has['mpl_bmassj'] | has['mpl_radj'])
+
+    good_lvl = np.zeros(len(extended), dtype=int)
+    hase = base_need & has['mpl_orbeccen']
+    good_lvl[hase] = 1
+    good_lvl[hase & (has['mpl_orbtper'] | has['mpl_orblper'])] = 2
+    good_lvl[hase & has['mpl_orbtper'] & has['mpl_orblper']] = 3
+    good_lvl[hase & has['mpl_orbtper'] & has['mpl_orblper'] & has['mpl_orbincl']] = 4
+
+    #order rows of each planet newest first
+    ranked = pandas.DataFrame({'name': extended['mpl_name'].values,
+                               'year': extended['publication_year'].values,
+                               'base': base_need,
+                               'lvl': good_lvl}, index=extended.index)
+    ranked = ranked[ranked['name'].isin(plnames)]
+    ranked = ranked.sort_values(by=['name', 'year'], ascending=[True, False])
+
+    #rows of a planet with the same year are ordered as by the (non-stable) per
+    #planet year sort this replaced, so redo that sort for planets with ties
+    ties = ranked.duplicated(subset=['name', 'year'], keep=False).values
+    if ties.any():
+        order = ranked.index.values.copy()
+        positions = ranked.groupby('name', sort=False).indices
+        for name in pandas.unique(ranked['name'].values[ties]):
+            pos = positions[name]
+            planet_rows = ranked.iloc[pos].sort_index()
+            order[pos] = planet_rows.sort_values(by=['year'], axis=0, ascending=False).index.values
+        ranked = ranked.loc[order]
+
+    #promote first row with basic info if the newest one doesn't have it
+    grp = ranked.groupby('name', sort=False)
+    first = grp.cumcount().values == 0
+    firstbase = ranked['base'].values & (grp['base'].cumsum().values == 1)
+    promote = firstbase & ~first
+    ranked.loc[promote, 'lvl'] = np.maximum(ranked.loc[promote, 'lvl'].values, 1)
+
+    #best is first row (in ranked order) with highest level
+    best = ranked.groupby('name', sort=False)['lvl'].idxmax().values
+
+    best_data = np.zeros(len(extended))
+    best_data[extended.index.get_indexer(best)] = 1
+
+    return best_data
+
+
+def genIPACschema(strings=(), floats=(), measured=(), links=()):
+    '''
+    Build a column:dtype schema for an archive table.  Measured quantities bring
+    along their err1, err2 and lim columns.  Reference link columns are parsed as
+    categoricals, since the same few thousand html strings repeat throughout.
+    '''
+
+    schema = {c:'object' for c in strings}
+    schema.update({c:'float64' for c in floats})
+    for c in measured:
+        schema.update({c+suff:'float64' for suff in ['','err1','err2','lim']})
+    schema.update({c:'category' for c in links})
+
+    return schema
+
+
+#columns of each IPAC table used by the pipeline or the KnownPlanets frontend
+ipacschemas = {
+    'compositepars': genIPACschema(strings=['fpl_name'],
+                                   floats=['fpl_radj','fst_optmag','fst_optmagerr','fst_optmaglim'],
+                                   measured=['fst_dist','fst_teff','fst_mass','fst_lum','fst_met','fst_age','fst_rad'],
+                                   links=['fpl_radreflink','fst_distreflink','fst_teffreflink','fst_massreflink',
+                                          'fst_lumreflink','fst_metreflink','fst_agereflink','fst_radreflink']),
+    'exoplanets': genIPACschema(strings=['pl_hostname','pl_letter','pl_name','pl_discmethod','pl_bmassprov',
+                                         'ra_str','dec_str','st_optband','st_spstr'],
+                                floats=['pl_status','pl_pnum','ra','dec','pl_angsep','st_plx','st_pmra','st_pmdec',
+                                        'st_radv','st_elat','st_elon','st_bmvj','gaia_plx','gaia_dist','gaia_gmag',
+                                        'gaia_pmra','gaia_pmdec','st_optmag','st_optmagerr','st_optmaglim'],
+                                measured=['pl_orbper','pl_orbsmax','pl_orbeccen','pl_orbincl','pl_orbtper',
+                                          'pl_orblper','pl_bmassj','pl_radj','pl_eqt','pl_insol','st_dist',
+                                          'st_teff','st_mass','st_lum','st_metfe','st_age','st_rad']),
+    'exomultpars': genIPACschema(strings=['mpl_name','mpl_bmassprov'],
+                                 floats=['mpl_def'],
+                                 measured=['mpl_orbper','mpl_orbsmax','mpl_orbeccen','mpl_orbincl','mpl_orbtper',
+                                           'mpl_orblper','mpl_bmassj','mpl_radj','mst_mass'],
+                                 links=['mpl_reflink']),
+    }
+
+
+ipacbaseurl = "https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI"
+
+
+def genIPACquery(table, select=None, where=None, baseurl=None):
+    '''
+    Build an archive API query url returning table as csv.  select is a list of
+    columns to return (all columns if None) and where an optional SQL row filter,
+    both evaluated by the archive so that only the needed data is transferred.
+    baseurl defaults to ipacbaseurl.
+    '''
+
+    if baseurl is None:
+        baseurl = ipacbaseurl
+
+    params = [('table',table), ('select',','.join(select) if select else '*')]
+    if where:
+        params.append(('where',where))
+    params.append(('format','csv'))
+
+    return baseurl+'?'+urlencode(params)
+
+
+def cacheIPACquery(query, cachedir=None, offline=False, session=None):
+    '''
+    Download the result of query (a full archive API url) into an on-disk cache
+    and return the path to the gzip compressed copy along with its metadata.
+
+    A cached copy is revalidated with the server via If-None-Match/If-Modified-Since
+    and kept on a 304 response.  If the server provides neither an ETag nor a
+    Last-Modified header, the response is downloaded and its sha256 compared against
+    the cached copy so that unchanged content is recognized.  With offline=True the
+    cached copy is returned without touching the network.
+    '''
+
+    if cachedir is None:
+        cachedir = os.path.join(os.getenv('HOME'),'.plandb','ipac_cache')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    key = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    csvfile = os.path.join(cachedir, key+'.csv.gz')
+    metafile = os.path.join(cachedir, key+'.json')
+
+    meta = None
+    if os.path.exists(csvfile) and os.path.exists(metafile):
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+
+    if offline:
+        if meta is None:
+            raise IOError("No cached copy of %s available in offline mode."%query)
+        return csvfile, meta
+
+    headers = {}
+    if meta is not None:
+        if meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    if session is None:
+        session = requests
+    r = session.get(query, headers=headers, stream=True)
+    if (r.status_code == 304) and (meta is not None):
+        r.close()
+        print("Cached copy of %s is current."%query)
+        return csvfile, meta
+    r.raise_for_status()
+
+    #the archive reports bad queries in the body of a normal response
+    chunks = r.iter_content(chunk_size=2**20)
+    first = next(chunks, b'')
+    if first.lstrip().startswith(b'ERROR'):
+        r.close()
+        raise IOError("Archive query %s failed:\n%s"%(query, first.strip()[:1000].decode('utf-8','replace')))
+
+    #stream response to disk, hashing as we go
+    sha = hashlib.sha256()
+    tmpfile = csvfile+'.tmp'
+    with gzip.open(tmpfile, 'wb') as f:
+        for chunk in itertools.chain([first], chunks):
+            sha.update(chunk)
+            f.write(chunk)
+
+    newmeta = {'query': query,
+               'etag': r.headers.get('ETag'),
+               'last_modified': r.headers.get('Last-Modified'),
+               'sha256': sha.hexdigest(),
+               'fetched': time.time()}
+    if (meta is not None) and (meta['sha256'] == newmeta['sha256']):
+        print("Content of %s is unchanged."%query)
+        os.remove(tmpfile)
+    else:
+        if os.path.exists(csvfile):
+            os.remove(csvfile)
+        os.rename(tmpfile, csvfile)
+    with open(metafile, 'w') as f:
+        json.dump(newmeta, f)
+
+    return csvfile, newmeta
+
+
+def readIPACquery(query, cachedir=None, offline=False, session=None, schema=None, engine='c'):
+    '''
+    Return the result of query (a full archive API url returning csv) as a DataFrame,
+    going through the on-disk cache of cacheIPACquery.  The parsed table is cached
+    alongside the download and reused as long as the content hash is unchanged.
+
+    If a schema (dict of column:dtype, see ipacschemas) is given, only those of its
+    columns present in the table are parsed, straight into the requested dtypes.
+    engine is passed on to pandas.read_csv ('c' or 'pyarrow').
+    '''
+
+    csvfile, meta = cacheIPACquery(query, cachedir=cachedir, offline=offline, session=session)
+
+    parsekey = hashlib.sha1((repr(sorted(schema.items())) if schema else '*').encode('utf-8') +
+                            engine.encode('utf-8')).hexdigest()[:8]
+    pklfile = csvfile.replace('.csv.gz', '_'+meta['sha256'][:16]+'_'+parsekey+'.pkl')
+    if os.path.exists(pklfile):
+        return pandas.read_pickle(pklfile)
+
+    usecols = None
+    dtype = None
+    if schema is not None:
+        with gzip.open(csvfile, 'rt') as f:
+            header = next(csv.reader(f))
+        usecols = [c for c in header if c in schema]
+        dtype = {c:schema[c] for c in usecols}
+
+    #parse directly from the compressed cache file so the raw text is never held in memory
+    data = pandas.read_csv(csvfile, compression='gzip', usecols=usecols, dtype=dtype, engine=engine)
+    #drop parsed copies of previous versions of this query
+    for f in glob.glob(csvfile.replace('.csv.gz', '_*.pkl')):
+        os.remove(f)
+    data.to_pickle(pklfile)
+
+    return data
+
+
+def fetchIPACqueries(queries, cachedir=None, offline=False, retries=3, backoff=2.0, schemas=None, engine='c'):
+    '''
+    Fetch and parse several archive queries concurrently via readIPACquery.
+
+    queries is a dict of name:query url and schemas an optional dict of name:schema
+    used to parse them.  All downloads share a single pooled
+    session and each one is retried up to retries times on connection errors or
+    server-side (5xx) failures, waiting backoff*2**attempt seconds in between.
+    Returns a dict of DataFrames with the same keys as queries.
+    '''
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(queries), pool_maxsize=len(queries))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def fetch(name):
+        tstart = time.time()
+        for attempt in range(retries+1):
+            try:
+                out = readIPACquery(queries[name], cachedir=cachedir, offline=offline, session=session,
+                                    schema=schemas.get(name) if schemas else None, engine=engine)
+                break
+            except requests.exceptions.RequestException as e:
+                if isinstance(e, requests.exceptions.HTTPError) and (e.response is not None) and \
+                        (e.response.status_code < 500):
+                    raise
+                if attempt == retries:
+                    raise
+                wait = backoff*2**attempt
+                print("Fetching %s failed (%s). Retrying in %3.1f s."%(name, e, wait))
+                time.sleep(wait)
+        print("Fetched %s (%d rows) in %3.2f s."%(name, len(out), time.time() - tstart))
+        return out
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        results = dict(zip(queries.keys(), pool.map(fetch, queries.keys())))
+    session.close()
+
+    return results
+
+
+spectypepattern = r'^([OBAFGKMLTY])(\d*\.\d+|\d+)'
+
+
+def spectralTypeLookup(spstr, func, pattern=spectypepattern):
+    '''
+    Evaluate a stellar property for an array of spectral type strings.
 
-def getIPACdata():
+    All strings (nulls allowed) are parsed in one pass with pattern, whose two groups
+    give the spectral class letter and numeric subclass.  func(letter, subclasses)
+    is called once per class with an array of that class's unique subclasses and
+    must return an array of values, which are broadcast back onto every row.  Rows
+    that don't parse get NaN.
+    '''
+
+    parsed = pandas.Series(np.array(spstr, dtype=object, ndmin=1)).str.extract(pattern)
+    ok = parsed.notnull().all(axis=1).values
+    out = np.full(len(parsed), np.nan)
+
+    letters = parsed[0].values[ok]
+    nums = parsed[1].values[ok].astype(float)
+    vals = np.zeros(letters.size)
+    for l in np.unique(letters):
+        inds = np.where(letters == l)[0]
+        un, inv = np.unique(nums[inds], return_inverse=True)
+        vals[inds] = np.array(func(l, un), ndmin=1)[inv]
+    out[ok] = vals
+
+    return out
+
+
+def getIPACdata(cachedir=None, offline=False, engine='c', baseurl=None, seed=None,
+                errmode='mc', nvalidate=50):
     '''
     grab everything from exoplanet and composite tables, merge,
     add additional column info and return/save to disk
+
+    Downloads go through the on-disk cache in cachedir (see cacheIPACquery).
+    Set offline to True to use cached tables only.  Only the columns listed
+    in ipacschemas are requested from the archive (at baseurl, defaulting to
+    ipacbaseurl) and parsed, using the pandas csv engine given by engine.
+    seed fixes the random draws of the Monte Carlo radius error estimates.
+    errmode selects how the radius errors are propagated: 'mc' (full Monte Carlo)
+    or 'delta' (linearized where possible, see linearUncertainty, with nvalidate
+    planets checked against Monte Carlo).
     '''
 
-    print("Querying IPAC for all data.")
-    query = """https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI?table=compositepars&select=*&format=csv"""
-    r = requests.get(query)
-    data = pandas.read_csv(StringIO(r.content))
+    if errmode not in ('mc', 'delta'):
+        raise ValueError("errmode must be 'mc' or 'delta'.")
 
-    query2 = """https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI?table=exoplanets&select=*&format=csv"""
-    r2 = requests.get(query2)
-    data2 = pandas.read_csv(StringIO(r2.content))
+    print("Querying IPAC for all data.")
+    #retracted planets (pl_status == 0) are dropped by the archive.  The remaining
+    #row filters depend on values merged in from the other tables, so are applied below.
+    queries = {name:genIPACquery(name, select=sorted(ipacschemas[name]), baseurl=baseurl)
+               for name in ipacschemas}
+    queries['exoplanets'] = genIPACquery('exoplanets', select=sorted(ipacschemas['exoplanets']),
+                                         where='pl_status<>0 or pl_status is null', baseurl=baseurl)
+    tables = fetchIPACqueries(queries, cachedir=cachedir, offline=offline, schemas=ipacschemas, engine=engine)
+
+    #put all reference link columns on one common set of categories so that they
+    #can be merged and copied between tables
+    linkcols = [(name,col) for name in tables for col in tables[name].columns if col.endswith('reflink')]
+    links = pandas.concat([tables[name][col].astype(object) for name,col in linkcols]).dropna().unique()
+    linktype = pandas.api.types.CategoricalDtype(links)
+    for name,col in linkcols:
+        tables[name][col] = tables[name][col].astype(linktype)
+
+    data = tables['compositepars']
+    data2 = tables['exoplanets']
+    data_ext = tables['exomultpars']
 
     #strip leading 'f' on data colnames
     colmap = {k:k[1:] if (k.startswith('fst_') | k.startswith('fpl_')) else k for k in data.keys()}
@@ -102,83 +731,25 @@ def getIPACdata():
     composite_cols.extend(['pl_radj', 'pl_radreflink'])
     data = data[composite_cols]
 
-    #sort by planet name
-    data = data.sort_values(by=['pl_name']).reset_index(drop=True)
-    data2 = data2.sort_values(by=['pl_name']).reset_index(drop=True)
-
-    #merge data sets
-    data = data.combine_first(data2)
+    #merge data sets by planet name, keeping only planets that made it through
+    #the filtered exoplanets query
+    data = data[data['pl_name'].isin(data2['pl_name'].values)]
+    data = data.set_index('pl_name').combine_first(data2.set_index('pl_name')).reset_index()
 
 
     # substitute data from the extended table.
-    print("Querying extended data table.")
-    #grab extended data table
-    query_ext = """https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI?table=exomultpars&select=*&format=csv"""
-    r_ext = requests.get(query_ext)
-    data_ext = pandas.read_csv(StringIO(r_ext.content))
 
     #create columns for short references and publication years
     extended = (data_ext.sort_values('mpl_name')).reset_index(drop=True)
     authregex = re.compile(r"(<a.*f>)|(</a>)")
-    shortrefs = [authregex.sub("", extended['mpl_reflink'][j]).strip() for j in range(len(extended))]
-    refs = extended["mpl_reflink"].values
-    refyrs = [int(re.findall('(\d{4})', ref)[0]) for ref in refs]
-    extended = extended.assign(ref_author=shortrefs,\
-                               publication_year=refyrs,\
-                               best_data=np.zeros(len(extended)))
+    shortrefs = extended['mpl_reflink'].str.replace(authregex, "", regex=True).str.strip()
+    refyrs = extended['mpl_reflink'].str.extract(r'(\d{4})', expand=False).astype(int)
+    extended = extended.assign(ref_author=shortrefs.values,\
+                               publication_year=refyrs.values)
 
     #pick best attribute row for each planet
     print("Choosing best attributes for all planets.")
-    for j,name in enumerate(data['pl_name'].values):
-        print("%s: %d/%d"%(name,j+1,len(data)))
-
-        planet_rows = extended.loc[extended["mpl_name"] == name]
-
-        sorted_rows = planet_rows.sort_values(by=["publication_year"], axis=0, ascending=False)
-        good_idx = sorted_rows.index[0]
-        good_lvl = 0
-        for index, row in sorted_rows.iterrows():
-            base_need = (not pandas.isnull(row["mpl_orbsmax"]) or not pandas.isnull(row["mpl_orbper"])) and \
-                        (not pandas.isnull(row["mpl_bmassj"]) or not pandas.isnull(row["mpl_radj"]))
-
-            # Has everything
-            if good_lvl < 4 and (base_need
-                                 and not pandas.isnull(row["mpl_orbeccen"]) and not pandas.isnull(row["mpl_orbtper"])
-                                 and not pandas.isnull(row["mpl_orblper"]) and not pandas.isnull(row["mpl_orbincl"])):
-                good_idx = index
-                good_lvl = 4
-                break
-
-            # Has everything except inclination
-            if good_lvl < 3 and (base_need
-                                 and not pandas.isnull(row["mpl_orbeccen"]) and not pandas.isnull(row["mpl_orbtper"])
-                                 and not pandas.isnull(row["mpl_orblper"])):
-                good_idx = index
-                good_lvl = 3
-
-            # Has either periapsis time or argument of pariapsis
-            elif good_lvl < 2 and (base_need
-                                   and not pandas.isnull(row["mpl_orbeccen"]) and (not pandas.isnull(row["mpl_orbtper"])
-                                                                          or not pandas.isnull(row["mpl_orblper"]))):
-                good_idx = index
-                good_lvl = 2
-            # Has eccentricity
-            elif good_lvl < 1 and (base_need
-                                   and not pandas.isnull(row["mpl_orbeccen"])):
-                good_idx = index
-                good_lvl = 1
-            # 1st doesn't have basic info
-            elif index == good_idx and not base_need:
-                good_idx = -1
-            # Previous row needed to be replaced
-            elif good_idx == -1 and base_need:
-                good_idx = index
-                good_lvl = 1
-
-        if good_idx == -1:
-            good_idx = sorted_rows.index[0]
-
-        extended.at[good_idx, "best_data"] = 1
+    extended = extended.assign(best_data=chooseBestAttributes(extended, data['pl_name'].values))
 
     #strip leading 'm' from all col names
     colmap = {k: k[1:] if (k.startswith('mst_') | k.startswith('mpl_')) else k for k in extended.keys()}
@@ -197,23 +768,23 @@ def getIPACdata():
 
     #update rows as needed
     print("Updating planets with best attributes.")
-    data = data.assign(pl_def_override=np.zeros(len(data)))
-    for j,name in enumerate(data['pl_name'].values):
-        print("%s: %d/%d"%(name,j+1,len(data)))
+    #line up the best extended row with every planet in data via a single join on pl_name
+    best = extended.loc[extended["best_data"] == 1, ['pl_name', 'pl_reflink'] + final_replace_columns]
+    best = data[['pl_name']].merge(best, on='pl_name', how='left', indicator=True)
+    hasbest = (best['_merge'] == 'both').values
 
-        row_extended = extended.loc[(extended["best_data"] == 1) & (extended["pl_name"] == name)]
-        idx = data.loc[(data["pl_name"] == name)].index
-
-        row_extended.index = idx
-        row_extended_replace = row_extended[final_replace_columns]
-        # Want to keep radius vals from composite table instead of replacing with null, so we don't null radius columns
-        data.loc[(data["pl_name"] == name,columns_to_null)] = np.nan
-        data.update(row_extended_replace,overwrite=True)
-        data.loc[idx,'pl_def_override'] = 1
-        data.loc[idx, 'pl_reflink'] = row_extended['pl_reflink'].values[0]
-
-        if not np.isnan(row_extended['pl_radj'].values[0]):
-            data.loc[idx, 'pl_radreflink'] = row_extended['pl_reflink'].values[0]
+    data = data.assign(pl_def_override=np.zeros(len(data)))
+    data.loc[hasbest, 'pl_def_override'] = 1
+    # Best row replaces orbit/mass columns outright (including nulls)
+    for col in columns_to_null:
+        data.loc[hasbest, col] = best[col].values[hasbest]
+    # Want to keep radius vals from composite table instead of replacing with null, so only take non-null radius columns
+    for col in rad_columns:
+        hasval = hasbest & best[col].notnull().values
+        data.loc[hasval, col] = best[col].values[hasval]
+    data.loc[hasbest, 'pl_reflink'] = best['pl_reflink'].values[hasbest]
+    hasrad = hasbest & best['pl_radj'].notnull().values
+    data.loc[hasrad, 'pl_radreflink'] = best['pl_reflink'].values[hasrad]
 
 
     #sort by planet name
@@ -232,25 +803,6 @@ def getIPACdata():
     data = data[keep]
     data = data.reset_index(drop=True)
 
-    #remove extraneous columns
-    data = data.drop(columns=['pl_rade',
-                              'pl_radelim',
-                              'pl_radserr2',
-                              'pl_radeerr1',
-                              'pl_rads',
-                              'pl_radslim',
-                              'pl_radeerr2',
-                              'pl_radserr1',
-                              'pl_masse',
-                              'pl_masseerr1',
-                              'pl_masseerr2',
-                              'pl_masselim',
-                              'pl_msinie',
-                              'pl_msinieerr1',
-                              'pl_msinieerr2',
-                              'pl_msinielim'
-                              ])
-
 
     #fill in missing smas from period & star mass
     nosma = np.isnan(data['pl_orbsmax'].values)
@@ -292,7 +844,14 @@ def getIPACdata():
     m = ((data['pl_bmassj'][noR].values*u.M_jupiter).to(u.M_earth)).value
     merr = (((data['pl_bmassjerr1'][noR].values - data['pl_bmassjerr2'][noR].values)/2.0)*u.M_jupiter).to(u.M_earth).value
     R = RfromM(m)
-    Rerr = [RfromM(np.random.normal(loc=m[j], scale=merr[j], size=int(1e4))).std() if not(np.isnan(merr[j])) else np.nan for j in range(len(m))]
+    rng = None if seed is None else np.random.RandomState(seed)
+    if errmode == 'delta':
+        res = linearUncertainty(RfromM, [m], [merr], derivs=[dRdM], breaks=[RfromMcoeffs()[2]],
+                                nvalidate=nvalidate, seed=rng)
+        reportLinearUncertainty('Forecaster radius', res)
+        Rerr = res['std']
+    else:
+        Rerr = propagateUncertainty(RfromM, [m], [merr], seed=rng)['std']
 
     #create mod forecaster radius column and error cols
     data = data.assign(pl_radj_forecastermod=data['pl_radj'].values)
@@ -304,67 +863,30 @@ def getIPACdata():
 
 
     # now the Fortney model
-    from EXOSIMS.PlanetPhysicalModel.FortneyMarleyCahoyMix1 import FortneyMarleyCahoyMix1
-    fortney = FortneyMarleyCahoyMix1()
-
-    ml10 = m <= 17
-    Rf = np.zeros(m.shape)
-    Rf[ml10] = fortney.R_ri(0.67,m[ml10])
-
-    mg10 = m > 17
-    tmpsmas = data['pl_orbsmax'][noR].values
-    tmpsmas = tmpsmas[mg10]
-    tmpsmas[tmpsmas < fortney.giant_pts2[:,1].min()] = fortney.giant_pts2[:,1].min()
-    tmpsmas[tmpsmas > fortney.giant_pts2[:,1].max()] = fortney.giant_pts2[:,1].max()
-
-    tmpmass = m[mg10]
-    tmpmass[tmpmass > fortney.giant_pts2[:,2].max()] = fortney.giant_pts2[:,2].max()
-
-    Rf[mg10] = griddata(fortney.giant_pts2, fortney.giant_vals2,( np.array([10.]*np.where(mg10)[0].size), tmpsmas, tmpmass))
+    fortneyR = genFortneyRadius()
+    Rf = fortneyR(m, data['pl_orbsmax'][noR].values)
 
     data = data.assign(pl_radj_fortney=data['pl_radj'].values)
-    #data['pl_radj_fortney'][noR] = ((Rf*u.R_earth).to(u.R_jupiter)).value
     data.loc[noR,'pl_radj_fortney'] = ((Rf*u.R_earth).to(u.R_jupiter)).value
 
-        # Calculate erros for fortney radius
-    Rf_err = []
+    # Calculate errors for fortney radius (mass draws are kept non-negative)
     tmpsmas = data['pl_orbsmax'][noR].values
     tmpsmaserr = (data['pl_orbsmaxerr1'][noR].values - data['pl_orbsmaxerr2'][noR].values) / 2.0
-    adist = np.zeros((len(m), int(1e4)))
-    for j in range(len(tmpsmas)):  # Create smax distribution
-        if np.isnan(tmpsmaserr[j]):
-            tmpsmaserr[j] = 0
-        adist[j, :] = (np.random.normal(loc=tmpsmas[j], scale=tmpsmaserr[j], size=int(1e4)))
-
-    for j in range(len(m)):  # Create m distribution and calculate errors
-        if np.isnan(merr[j]):
-            merr[j] = 0
-        mdist = (np.random.normal(loc=m[j], scale=merr[j], size=int(1e4)))
-
-        for i in range(len(mdist)):
-            while mdist[i] < 0:
-                mdist[i] = (np.random.normal(loc=m[j], scale=merr[j], size=int(1)))
-
-        ml10_dist = mdist <= 17
-        Rf_dist = np.zeros(mdist.shape)
-        Rf_dist[ml10_dist] = fortney.R_ri(0.67, mdist[ml10_dist])
-
-        cur_adist = adist[j, :]
-        mg10_dist = mdist > 17
-        tmpsmas = cur_adist[mg10_dist]
-        tmpsmas[tmpsmas < fortney.giant_pts2[:, 1].min()] = fortney.giant_pts2[:, 1].min()
-        tmpsmas[tmpsmas > fortney.giant_pts2[:, 1].max()] = fortney.giant_pts2[:, 1].max()
-
-        tmpmass = mdist[mg10_dist]
-        tmpmass[tmpmass > fortney.giant_pts2[:, 2].max()] = fortney.giant_pts2[:, 2].max()
-
-        Rf_dist[mg10_dist] = griddata(fortney.giant_pts2, fortney.giant_vals2,
-                                      (np.array([10.] * np.where(mg10_dist)[0].size), tmpsmas, tmpmass))
-        Rf_err.append(Rf_dist.std())
+    tmpsmaserr[np.isnan(tmpsmaserr)] = 0
+    tmpmerr = merr.copy()
+    tmpmerr[np.isnan(tmpmerr)] = 0
+    if errmode == 'delta':
+        res = linearUncertainty(fortneyR, [m, tmpsmas], [tmpmerr, tmpsmaserr], breaks=fortneyR.breaks,
+                                lower=[0., None], nvalidate=nvalidate, seed=rng)
+        reportLinearUncertainty('Fortney radius', res)
+        Rf_err = res['std']
+    else:
+        Rf_err = propagateUncertainty(fortneyR, [m, tmpsmas], [tmpmerr, tmpsmaserr],
+                                      lower=[0., None], seed=rng)['std']
 
     data = data.assign(pl_radj_fortneyerr1=data['pl_radjerr1'].values)
     data.loc[noR, 'pl_radj_fortneyerr1'] = ((Rf_err * u.R_earth).to(u.R_jupiter)).value
-    data = data.assign(pl_radj_forecastermoderr2=data['pl_radjerr2'].values)
+    data = data.assign(pl_radj_fortneyerr2=data['pl_radjerr2'].values)
     data.loc[noR, 'pl_radj_fortneyerr2'] = -((Rf_err * u.R_earth).to(u.R_jupiter)).value
 
 
@@ -391,35 +913,41 @@ def getIPACdata():
     data.loc[nolum_teff, 'st_lum'] = lums_1
 
     nolum_noteff_spect = np.isnan(data['st_lum'].values) & ~data['st_spstr'].isnull().values
-    spects = data.loc[nolum_noteff_spect, 'st_spstr']
-    lums2 = []
-    for str_row in spects.values:
-        spec_letter = str_row[0]
-        # spec_rest.append(str_row[1:])
-        spec_num_match = re.search("^[0-9,]+", str_row[1:])
-        if spec_num_match is not None:
-            spec_num = str_row[spec_num_match.start() + 1:spec_num_match.end() + 1]
-            # Calculates luminosity when teff does not exist but spectral type exists
-            lums2.append(ms.SpTOther('logL', spec_letter, spec_num))
-        else:
-            lums2.append(np.nan)
-    data.loc[nolum_noteff_spect, 'st_lum'] = lums2
+    # Calculates luminosity when teff does not exist but spectral type exists
+    data.loc[nolum_noteff_spect, 'st_lum'] = spectralTypeLookup(data.loc[nolum_noteff_spect, 'st_spstr'].values,
+                                                                lambda l,n: ms.SpTOther('logL', l, n))
 
     return data
 
 
-def packagePhotometryData(dbfile=None):
+def patchPhotometryNaNs(wavelns, vals, nans):
+    """
+    Fill the NaN wavelengths (boolean mask nans) of the rows of vals (all sharing
+    the same NaN pattern) by cubic interpolation along wavelength.  Returns the
+    filled values (rows x nans.sum()).
+    """
+
+    return interp1d(wavelns[~nans],vals[:,~nans],kind='cubic',axis=1)(wavelns[nans])
+
+
+def packagePhotometryData(dbfile=None, nprocs=None, batchsize=500):
     """
     Read photometry data from database of grid models and repackage into single ndarray of data
+
+    The model tables are read in bulk, batchsize tables per query (500 is the sqlite
+    limit on compound selects).  Individual missing wavelengths are filled in by
+    cubic interpolation, with cells sharing the same missing wavelengths patched
+    together and spread over nprocs processes (defaults to the number of cpus, 1 to
+    run in this process).
     """
     if dbfile is None:
         dbfile = os.path.join(os.getenv('HOME'),'Documents','AFTA-Coronagraph','ColorFun','AlbedoModels_2015.db')
 
     # grab photometry data
-    enginel = create_engine('sqlite:///' + dbfile)
+    conn = sqlite3.connect(dbfile)
 
     # getting values
-    meta_alb = pandas.read_sql_table('header',enginel)
+    meta_alb = pandas.read_sql_query('SELECT * FROM header',conn)
     metallicities = meta_alb.metallicity.unique()
     metallicities.sort()
     betas = meta_alb.phase.unique()
@@ -436,54 +964,268 @@ def packagePhotometryData(dbfile=None):
     cloudstr[cloudstr == 'f3.0'] = 'f3'
     cloudstr[cloudstr == 'f6.0'] = 'f6'
 
-    tmp = pandas.read_sql_table('g25_t150_m0.0_d0.5_NC_phang000',enginel)
-    wavelns = tmp.WAVELN.values
+    wavelns = np.array(conn.execute('SELECT WAVELN FROM "g25_t150_m0.0_d0.5_NC_phang000"').fetchall(),dtype=float).flatten()
+
+    #table name of every grid cell, in the (flattened) order of allphotdata
+    names = ['g25_t150_m'+str(fe)+'_d'+str(d)+'_'+cs+'_phang'+"%03d"%beta
+             for fe,d,cs,beta in itertools.product(metallicities,dists,cloudstr,betas)]
+    tables = set(r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    for name in names:
+        if name not in tables:
+            print("Missing: %s"%name)
+    cells = [(n,name) for n,name in enumerate(names) if name in tables]
+
+    #read all tables in large batches of UNION ALL queries and scatter into the grid
+    allphotdata = np.full((len(names), wavelns.size), np.nan)
+    counts = np.zeros(len(names), dtype=int)
+    for b in range(0, len(cells), batchsize):
+        query = ' UNION ALL '.join('SELECT %d, WAVELN, GEOMALB FROM "%s"'%(n,name) for n,name in cells[b:b+batchsize])
+        rows = np.array(conn.execute(query).fetchall(), dtype=float)
+        if rows.size == 0:
+            continue
+        cellinds = rows[:,0].astype(int)
+        winds = np.clip(np.searchsorted(wavelns, rows[:,1]), 0, wavelns.size-1)
+        good = wavelns[winds] == rows[:,1]
+        allphotdata[cellinds[good], winds[good]] = rows[good,2]
+        counts += np.bincount(cellinds[good], minlength=len(names))
+        print("Read %d/%d tables"%(min(b+batchsize, len(cells)), len(cells)))
+    conn.close()
+
+    for n,name in cells:
+        if counts[n] != wavelns.size:
+            print("Filled value: %s, %s"%(name,list(wavelns[np.isnan(allphotdata[n])])))
+
+    #patch individual nans, grouping cells by which wavelengths are missing
+    nans = np.isnan(allphotdata)
+    patch = np.where(nans.any(axis=1) & ~nans.all(axis=1))[0]
+    if patch.size > 0:
+        patterns,pinds = np.unique(nans[patch], axis=0, return_inverse=True)
+        pinds = pinds.flatten()
+        tasks = []
+        for p,pattern in enumerate(patterns):
+            inds = patch[pinds == p]
+            for c in range(0, inds.size, 1000):
+                tasks.append((inds[c:c+1000], pattern))
+        args = ([wavelns]*len(tasks), [allphotdata[inds] for inds,pattern in tasks], [pattern for inds,pattern in tasks])
+        if nprocs == 1:
+            filled = map(patchPhotometryNaNs, *args)
+        else:
+            executor = ProcessPoolExecutor(max_workers=nprocs)
+            filled = executor.map(patchPhotometryNaNs, *args)
+        for (inds,pattern),vals in zip(tasks,filled):
+            allphotdata[np.ix_(inds, np.where(pattern)[0])] = vals
+        if nprocs != 1:
+            executor.shutdown()
 
-    allphotdata = np.zeros((metallicities.size, dists.size, clouds.size, betas.size, wavelns.size))
-    for i,fe in enumerate(metallicities):
-        basename = 'g25_t150_m'+str(fe)+'_d'
-        for j,d in enumerate(dists):
-            basename2 = basename+str(d)+'_'
-            for k,cloud in enumerate(clouds):
-                basename3 = basename2+cloudstr[k]+'_phang'
-                print(basename3)
-                for l,beta in enumerate(betas):
-                    name = basename3+"%03d"%beta
-                    try:
-                        tmp = pandas.read_sql_table(name,enginel)
-                    except:
-                        print("Missing: %s"%name)
-                        allphotdata[i,j,k,l,:] = np.nan
-                        continue
-                    pvals = tmp['GEOMALB'].values
-                    if len(tmp) != len(wavelns):
-                        missing = list(set(wavelns) - set(tmp.WAVELN.values))
-                        inds  = np.searchsorted(tmp['WAVELN'].values,missing)
-                        pvals = np.insert(pvals,inds,np.nan)
-                        assert np.isnan(pvals[wavelns==missing[0]])
-                        print("Filled value: %s, %s"%(name,missing))
-                    allphotdata[i,j,k,l,:] = pvals
-
-    #patch individual nans
-    for i,fe in enumerate(metallicities):
-        for j,d in enumerate(dists):
-            for k,cloud in enumerate(clouds):
-                for l,beta in enumerate(betas):
-                    nans = np.isnan(allphotdata[i,j,k,l,:])
-                    if np.any(nans) & ~np.all(nans):
-                        tmp = interp1d(wavelns[~nans],allphotdata[i,j,k,l,~nans],kind='cubic')
-                        allphotdata[i,j,k,l,nans] = tmp(wavelns[nans])
+    allphotdata = allphotdata.reshape((metallicities.size, dists.size, clouds.size, betas.size, wavelns.size))
 
     outname = os.path.split(dbfile)[-1].split(os.extsep)[0]
-    np.savez(outname,metallicities=metallicities,dists=dists,clouds=clouds,cloudstr=cloudstr,betas=betas,wavelns=wavelns,allphotdata=allphotdata)
+    savePhotometryData(outname,metallicities,dists,clouds,cloudstr,betas,wavelns,allphotdata)
+
 
-def loadPhotometryData(infile='allphotdata_2015.npz'):
+def savePhotometryData(outname, metallicities, dists, clouds, cloudstr, betas, wavelns, allphotdata):
     """
-    Read stored photometry data from disk and generate interpolants over data
+    Write the photometry grid to outname.npy (uncompressed, so that loadPhotometryData
+    can memory map it) with the grid axes and the sha1 of the .npy file (see
+    hashPhotometryGrid) in the small outname.json sidecar
+    """
+
+    np.save(outname+'.npy', np.ascontiguousarray(allphotdata, dtype=float))
+    sha = hashlib.sha1()
+    with open(outname+'.npy', 'rb') as f:
+        for chunk in iter(lambda: f.read(2**24), b''):
+            sha.update(chunk)
+
+    meta = {'metallicities': [float(v) for v in metallicities],
+            'dists': [float(v) for v in dists],
+            'clouds': [float(v) for v in clouds],
+            'cloudstr': [str(v) for v in cloudstr],
+            'betas': [float(v) for v in betas],
+            'wavelns': [float(v) for v in wavelns],
+            'sha1': sha.hexdigest()}
+    with open(outname+'.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def convertPhotometryData(infile='allphotdata_2015.npz'):
+    """
+    Convert a photometry grid stored in the old .npz format to the .npy/.json
+    format (written next to it, with the same name)
     """
 
     tmp = np.load(infile)
-    allphotdata = tmp['allphotdata']
+    savePhotometryData(os.path.splitext(infile)[0], tmp['metallicities'], tmp['dists'], tmp['clouds'],
+                       tmp['cloudstr'], tmp['betas'], tmp['wavelns'], tmp['allphotdata'])
+
+
+def hashPhotometryGrid(infile):
+    """
+    Hash identifying the photometry grid in infile (and its .json sidecar, if any)
+    along with the scipy version used to fit splines to it.  The grid itself is
+    not read: it is identified by the sha1 stored in the sidecar by
+    savePhotometryData or, failing that (e.g. .npz files), by its size and
+    modification time.
+    """
+
+    sha = hashlib.sha1()
+    meta = {}
+    jsonfile = os.path.splitext(infile)[0]+'.json'
+    if os.path.exists(jsonfile):
+        with open(jsonfile, 'rb') as f:
+            raw = f.read()
+        sha.update(raw)
+        if not infile.endswith('.npz'):
+            meta = json.loads(raw.decode('utf-8'))
+    if 'sha1' not in meta:
+        st = os.stat(infile)
+        sha.update(('%d %r'%(st.st_size, st.st_mtime)).encode('utf-8'))
+    sha.update(scipy.__version__.encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+class CellInterpCache(object):
+    """
+    Least recently used cache of the per cell interpolants of a photometry grid
+    (betas x wavelns cells of allphotdata, indexed by metallicity, distance and
+    cloud).  Interpolants are built on first use, and at most maxsize of them are
+    kept.  If cachedir is set, fitted spline coefficients are stored there (one
+    file per cell) and later loaded instead of refitting.
+    """
+
+    def __init__(self, allphotdata, betas, wavelns, cachedir=None, maxsize=256):
+        self.allphotdata = allphotdata
+        self.betas = betas
+        self.wavelns = wavelns
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.cells = collections.OrderedDict()
+        if (cachedir is not None) and not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def get(self, kind, i, j, k):
+        """Interpolant of kind 'phot' (see buildPhotInterp) or 'quad' (see buildQuadInterp)"""
+
+        key = (kind, i, j, k)
+        if key in self.cells:
+            self.cells[key] = self.cells.pop(key)
+            return self.cells[key]
+
+        if kind == 'phot':
+            interp = self.loadSpline(i, j, k)
+        elif kind == 'quad':
+            interp = buildQuadInterp(self.wavelns, np.asarray(self.allphotdata[i,j,k]))
+        else:
+            raise ValueError("kind must be 'phot' or 'quad'.")
+
+        self.cells[key] = interp
+        while len(self.cells) > self.maxsize:
+            self.cells.popitem(last=False)
+
+        return interp
+
+    def loadSpline(self, i, j, k):
+        """Spline of cell i,j,k from cachedir if stored there, otherwise fit (and store) it"""
+
+        if self.cachedir is None:
+            return buildPhotInterp(self.betas, self.wavelns, np.asarray(self.allphotdata[i,j,k]))
+
+        fname = os.path.join(self.cachedir, '%d_%d_%d.npz'%(i,j,k))
+        if os.path.exists(fname):
+            with np.load(fname) as tmp:
+                interp = object.__new__(RectBivariateSpline)
+                interp.tck = (tmp['tx'], tmp['ty'], tmp['c'])
+                interp.degrees = tuple(int(v) for v in tmp['degrees'])
+                interp.fp = float(tmp['fp'])
+            return interp
+
+        interp = buildPhotInterp(self.betas, self.wavelns, np.asarray(self.allphotdata[i,j,k]))
+        #write to a temporary file first so that concurrent readers never see a partial file
+        tmpname = fname+'.%d.tmp'%os.getpid()
+        with open(tmpname, 'wb') as f:
+            np.savez(f, tx=interp.tck[0], ty=interp.tck[1], c=interp.tck[2],
+                     degrees=np.array(interp.degrees), fp=interp.fp)
+        os.replace(tmpname, fname)
+
+        return interp
+
+
+class LazyCellInterps(object):
+    """
+    Interpolants over the cells of one (metallicity, distance) slice of the
+    photometry grid, keyed by cloud value, served from a CellInterpCache
+    """
+
+    def __init__(self, cache, kind, i, j, clouds):
+        self.cache = cache
+        self.kind = kind
+        self.i = i
+        self.j = j
+        self.clouds = clouds
+
+    def __getitem__(self, cloud):
+        k = np.where(self.clouds == cloud)[0]
+        if k.size == 0:
+            raise KeyError(cloud)
+        return self.cache.get(self.kind, self.i, self.j, k[0])
+
+    def __contains__(self, cloud):
+        return np.any(self.clouds == cloud)
+
+    def __iter__(self):
+        return iter(self.clouds)
+
+    def __len__(self):
+        return len(self.clouds)
+
+    def keys(self):
+        return list(self.clouds)
+
+
+def buildPhotInterp(betas, wavelns, celldata):
+    """
+    Spline over phase angle and wavelength for one grid cell (betas x wavelns)
+    """
+
+    if np.any(np.isnan(celldata)):
+        #remove whole rows of betas
+        goodbetas = np.array(list(set(range(len(betas))) - set(np.unique(np.where(np.isnan(celldata))[0]))))
+        return RectBivariateSpline(betas[goodbetas],wavelns,celldata[goodbetas,:])
+    return RectBivariateSpline(betas,wavelns,celldata)
+
+
+def buildQuadInterp(wavelns, celldata):
+    """
+    Interpolant over wavelength at quadrature (beta index 9) for one grid cell
+    """
+
+    return interp1d(wavelns,celldata[9,:].flatten())
+
+def loadPhotometryData(infile=None, cachedir=None, maxcells=256):
+    """
+    Read stored photometry data from disk and generate interpolants over data
+
+    infile is either a .npy grid with a .json sidecar of grid axes (see
+    savePhotometryData), which is memory mapped, or an old style .npz file, which
+    is read into memory.  Defaults to allphotdata_2015.npy if it exists, and
+    allphotdata_2015.npz otherwise.  The interpolants for each grid cell are only
+    built (and their data read) on first use, and at most maxcells of them are
+    kept in memory.  Fitted splines (and the band tables of getBandTables) are
+    stored under cachedir (default $HOME/.plandb/phot_cache), in a subdirectory
+    named by the hash of the grid, and reused by later calls.  Set cachedir=False
+    to disable this.
+    """
+
+    if infile is None:
+        infile = 'allphotdata_2015.npy' if os.path.exists('allphotdata_2015.npy') else 'allphotdata_2015.npz'
+
+    if infile.endswith('.npz'):
+        tmp = np.load(infile)
+        allphotdata = tmp['allphotdata']
+    else:
+        with open(os.path.splitext(infile)[0]+'.json') as f:
+            tmp = dict((k,np.array(v)) for k,v in json.load(f).items())
+        allphotdata = np.load(infile, mmap_mode='r')
     clouds = tmp['clouds']
     cloudstr = tmp['cloudstr']
     wavelns = tmp['wavelns']
@@ -500,6 +1242,13 @@ def loadPhotometryData(infile='allphotdata_2015.npz'):
     feinterp = makeninterp(metallicities)
     cloudinterp = makeninterp(clouds)
 
+    if cachedir is False:
+        cellcachedir = None
+    else:
+        if cachedir is None:
+            cachedir = os.path.join(os.getenv('HOME'),'.plandb','phot_cache')
+        cellcachedir = os.path.join(cachedir, hashPhotometryGrid(infile))
+    cache = CellInterpCache(allphotdata, betas, wavelns, cachedir=cellcachedir, maxsize=maxcells)
 
     photinterps2 = {}
     quadinterps = {}
@@ -507,18 +1256,8 @@ def loadPhotometryData(infile='allphotdata_2015.npz'):
         photinterps2[fe] = {}
         quadinterps[fe] = {}
         for j,d in enumerate(dists):
-            photinterps2[fe][d] = {}
-            quadinterps[fe][d] = {}
-            for k,cloud in enumerate(clouds):
-                if np.any(np.isnan(allphotdata[i,j,k,:,:])):
-                    #remove whole rows of betas
-                    goodbetas = np.array(list(set(range(len(betas))) - set(np.unique(np.where(np.isnan(allphotdata[i,j,k,:,:]))[0]))))
-                    photinterps2[fe][d][cloud] = RectBivariateSpline(betas[goodbetas],wavelns,allphotdata[i,j,k,goodbetas,:])
-                    #photinterps2[fe][d][cloud] = interp2d(betas[goodbetas],wavelns,allphotdata[i,j,k,goodbetas,:].transpose(),kind='cubic')
-                else:
-                    #photinterps2[fe][d][cloud] = interp2d(betas,wavelns,allphotdata[i,j,k,:,:].transpose(),kind='cubic')
-                    photinterps2[fe][d][cloud] = RectBivariateSpline(betas,wavelns,allphotdata[i,j,k,:,:])
-                quadinterps[fe][d][cloud] = interp1d(wavelns,allphotdata[i,j,k,9,:].flatten())
+            photinterps2[fe][d] = LazyCellInterps(cache, 'phot', i, j, clouds)
+            quadinterps[fe][d] = LazyCellInterps(cache, 'quad', i, j, clouds)
 
     return {'allphotdata':allphotdata,
             'clouds':clouds,
@@ -532,7 +1271,8 @@ def loadPhotometryData(infile='allphotdata_2015.npz'):
             'feinterp':feinterp,
             'cloudinterp':cloudinterp,
             'photinterps':photinterps2,
-            'quadinterps':quadinterps}
+            'quadinterps':quadinterps,
+            'cachedir':cellcachedir}
 
 
 def genBands():
@@ -561,344 +1301,771 @@ def genBands():
     return zip(lambdas,bands,bws,bandws,bandwsteps)
 
 
-def calcQuadratureVals(data, bandzip, photdict):
+def nearestIndex(grid, vals):
     """
-    Calculate quadrature photometry values for planets in data (output of getIPACdata)
-    for bands in bandzip (output of genBands) assuming photometry info from photdict
-    (output from loadPhotometryData)
+    Index of the nearest grid value (grid sorted ascending) to each of vals, with
+    values off the ends of the grid mapped to the first/last index.  Matches the
+    nearest neighbor interpolants (feinterp, distinterp, etc.) of loadPhotometryData.
+    """
+
+    grid = np.asarray(grid)
+    return np.searchsorted(grid[:-1] + np.diff(grid)/2., vals, side='left')
+
 
+def genBandTables(photdict, bandzip, dbeta=0.25):
+    """
+    Pre-integrate the photometry grid in photdict (output of loadPhotometryData)
+    over each band in bandzip (output of genBands).
+
+    For every band and (metallicity, distance, cloud) cell, the band averaged
+    pPhi(beta) is tabulated on a grid of phase angles with spacing dbeta (deg),
+    along with the band averaged quadrature value of quadinterps.  The tables are
+    evaluated with bandPPhi.  The worst case (midpoint) error of linear and cubic
+    table interpolation against the full spline evaluation is measured on
+    construction and stored as fractions of each cell's peak pPhi.
     """
 
-    smas = data['pl_orbsmax'].values
-    fes = data['st_metfe'].values
-    fes[np.isnan(fes)] = 0.0
-    Rps = data['pl_radj_forecastermod'].values
-    inc = data['pl_orbincl'].values
-    eccen = data['pl_orbeccen'].values
-    arg_per = data['pl_orblper'].values
-    lum = data['st_lum'].values
+    bandzip = list(bandzip)
+    metallicities = photdict['metallicities']
+    dists = photdict['dists']
+    clouds = photdict['clouds']
+    nbands = len(bandzip)
+
+    betas = np.linspace(0, 180, int(round(180./dbeta)) + 1)
+    midbetas = betas[:-1] + np.diff(betas)/2.
+    wsall, winds = np.unique(np.hstack([ws for l,band,bw,ws,wstep in bandzip]), return_inverse=True)
+    winds = winds.reshape(nbands, -1)
+    wsteps = np.array([wstep for l,band,bw,ws,wstep in bandzip])
+    bws = np.array([bw for l,band,bw,ws,wstep in bandzip])
+
+    def bandavg(vals):
+        #vals is (..., wavelengths in wsall) -> (..., bands)
+        out = np.stack([vals[...,winds[b]].sum(-1)*wsteps[b]/bws[b] for b in range(nbands)], axis=-1)
+        out[np.isinf(out)] = np.nan
+        return out
+
+    pphi = np.zeros((nbands, metallicities.size, dists.size, clouds.size, betas.size))
+    quad = np.zeros((nbands, metallicities.size, dists.size, clouds.size))
+    maxerr = {'linear': 0., 'cubic': 0.}
+    tables = {'lambdas': np.array([l for l,band,bw,ws,wstep in bandzip]), 'bws': bws,
+              'betas': betas, 'dbeta': betas[1] - betas[0], 'pphi': pphi, 'quad': quad}
+    for i,fe in enumerate(metallicities):
+        for j,d in enumerate(dists):
+            for k,cloud in enumerate(clouds):
+                spline = photdict['photinterps'][fe][d][cloud]
+                pphi[:,i,j,k,:] = bandavg(spline(betas, wsall)).T
+                quad[:,i,j,k] = bandavg(photdict['quadinterps'][fe][d][cloud](wsall))
 
-    tmpout = {}
+                truth = bandavg(spline(midbetas, wsall)).T
+                scale = np.nanmax(np.abs(truth), axis=1)[:,None]
+                for kind in maxerr:
+                    approx = bandPPhi(tables, np.arange(nbands)[:,None], i, j, k, midbetas, kind=kind)
+                    err = np.abs(approx - truth)/scale
+                    if np.any(np.isfinite(err)):
+                        maxerr[kind] = max(maxerr[kind], np.nanmax(err))
+    tables['maxerr'] = maxerr
+    print("Band tables built (dbeta = %g deg). Max error relative to peak pPhi: linear %.3g, cubic %.3g."%(
+          tables['dbeta'], maxerr['linear'], maxerr['cubic']))
 
-    quadinterps = photdict['quadinterps']
-    feinterp = photdict['feinterp']
-    distinterp = photdict['distinterp']
-    lambdas = []
-
-    #iterate over all data rows
-    for j, (Rp, fe,a, I, e, w, lm) in enumerate(zip(Rps, fes,smas, inc, eccen, arg_per, lum)):
-        print("%d/%d"%(j+1,len(Rps)))
-        for c in photdict['clouds']:
-            for l,band,bw,ws,wstep in bandzip:
-                if j == 0:
-                    lambdas.append(l)
-                    #allocate output arrays
-                    tmpout['quad_pPhi_'+"%03dC_"%(c*100)+str(l)+"NM"] = np.zeros(smas.shape)
-                    tmpout['quad_dMag_'+"%03dC_"%(c*100)+str(l)+"NM"] = np.zeros(smas.shape)
-                    tmpout['quad_radius_' + "%03dC_" % (c * 100) + str(l) + "NM"] = np.zeros(smas.shape)
-
-                if np.isnan(lm):
-                    lum_fix = 1
-                else:
-                    lum_fix = (10 ** lm) ** .5  # Since lum is log base 10 of solar luminosity
-
-
-                #Only calculate quadrature distance if known eccentricity and argument of periaps,
-                #and not face-on orbit
-                if not np.isnan(e) and not np.isnan(w) and I != 0:
-                    nu1 = -w
-                    nu2 = np.pi - w
-
-                    r1 = a * (1.0 - e ** 2.0) / (1.0 + e * np.cos(nu1)) / lum_fix
-                    r2 = a * (1.0 - e ** 2.0) / (1.0 + e * np.cos(nu2)) / lum_fix
-
-                    pphi1 = quadinterps[float(feinterp(fe))][float(distinterp(r1))][c](ws).sum() * wstep / bw
-                    pphi2 = quadinterps[float(feinterp(fe))][float(distinterp(r2))][c](ws).sum() * wstep / bw
-                    if np.isinf(pphi1):
-                        print("Inf value encountered in pphi")
-                        pphi1 = np.nan
-                    if np.isinf(pphi2):
-                        print("Inf value encountered in pphi")
-                        pphi2 = np.nan
-
-                    dMag1 = deltaMag(1, Rp * u.R_jupiter, r1 * u.AU, pphi1)
-                    dMag2 = deltaMag(1, Rp * u.R_jupiter, r2 * u.AU, pphi2)
-                    if np.isnan(dMag2) or dMag1 < dMag2:
-                        dMag = dMag1
-                        pphi = pphi1
-                        r = r1
-                    else:
-                        dMag = dMag2
-                        pphi = pphi2
-                        r = r2
-                    tmpout['quad_pPhi_' + "%03dC_" % (c * 100) + str(l) + "NM"][j] = pphi
-                    tmpout['quad_radius_' + "%03dC_" % (c * 100) + str(l) + "NM"][j] = r
-                else:
-                    pphi = quadinterps[float(feinterp(fe))][float(distinterp(a/lum_fix))][c](ws).sum()*wstep/bw
-                    if np.isinf(pphi):
-                        print("Inf value encountered in pphi")
-                        pphi = np.nan
+    return tables
 
-                    tmpout['quad_pPhi_'+"%03dC_"%(c*100)+str(l)+"NM"][j] = pphi
-                    dMag = deltaMag(1, Rp*u.R_jupiter, a*u.AU, pphi)
-                    tmpout['quad_radius_' + "%03dC_" % (c * 100) + str(l) + "NM"][j] = a / lum_fix
 
-                if np.isinf(dMag):
-                    print("Inf value encountered in dmag")
-                    dMag = np.nan
-                tmpout['quad_dMag_'+"%03dC_"%(c*100)+str(l)+"NM"][j] = dMag
+def getBandTables(photdict, bandzip, dbeta=0.25):
+    """
+    Return the genBandTables output for photdict and bandzip, building it on first
+    use and keeping it in photdict so that every stage shares one copy.  If
+    photdict has a cache directory (see loadPhotometryData), the tables are also
+    stored there and loaded by later processes.
+    """
 
-    for l in lambdas:
-        tmp = []
-        for c in photdict['clouds']:
-            tmp.append(tmpout['quad_dMag_'+"%03dC_"%(c*100)+str(l)+"NM"])
-        tmp = np.vstack(tmp)
-        tmpout["quad_dMag_min_"+str(l)+"NM"] = np.nanmin(tmp,axis=0)
-        tmpout["quad_dMag_max_"+str(l)+"NM"] = np.nanmax(tmp,axis=0)
-        tmpout["quad_dMag_med_"+str(l)+"NM"] = np.nanmedian(tmp,axis=0)
+    bandzip = list(bandzip)
+    key = (tuple(l for l,band,bw,ws,wstep in bandzip), tuple(bw for l,band,bw,ws,wstep in bandzip), dbeta)
+    if 'bandtables' not in photdict:
+        photdict['bandtables'] = {}
+    if key in photdict['bandtables']:
+        return photdict['bandtables'][key]
+
+    fname = None
+    if photdict.get('cachedir') is not None:
+        sha = hashlib.sha1(repr(key).encode('utf-8'))
+        for l,band,bw,ws,wstep in bandzip:
+            sha.update(np.ascontiguousarray(ws, dtype=float).tobytes())
+        fname = os.path.join(photdict['cachedir'], 'bandtables_'+sha.hexdigest()+'.npz')
+
+    if (fname is not None) and os.path.exists(fname):
+        with np.load(fname) as tmp:
+            tables = dict((k, tmp[k]) for k in ['lambdas','bws','betas','pphi','quad'])
+            tables['dbeta'] = float(tmp['dbeta'])
+            tables['maxerr'] = {'linear': float(tmp['maxerr_linear']), 'cubic': float(tmp['maxerr_cubic'])}
+    else:
+        tables = genBandTables(photdict, bandzip, dbeta=dbeta)
+        if fname is not None:
+            tmpname = fname+'.%d.tmp'%os.getpid()
+            with open(tmpname, 'wb') as f:
+                np.savez(f, maxerr_linear=tables['maxerr']['linear'], maxerr_cubic=tables['maxerr']['cubic'],
+                         **dict((k, tables[k]) for k in ['lambdas','bws','betas','dbeta','pphi','quad']))
+            os.replace(tmpname, fname)
+    photdict['bandtables'][key] = tables
 
-    data = data.join(pandas.DataFrame(tmpout))
+    return tables
 
-    return data
 
+def bandPPhi(tables, band, fe_idx, d_idx, cloud_idx, beta, kind='linear'):
+    """
+    Band averaged pPhi from the tables of genBandTables at phase angles beta (deg).
 
-def genOrbitData(data, bandzip, photdict, t0=None):
-    """ Generate data for one orbital period starting at absolute time t0 (if time
-    of periapsis is known) for all planets in data (output of getIPACdata)
-    based on photometric data in photdict (output of loadPhotometryData) for bands
-    in bandzip (output of genBands)
+    band, fe_idx, d_idx and cloud_idx are integer indices into the bands and the
+    photometry grid (see nearestIndex) and, along with beta, may be arrays of any
+    mutually broadcastable shapes.  kind is 'linear' or 'cubic' (Catmull-Rom)
+    interpolation in beta.  NaN betas give NaN.
     """
 
-    if t0 is None:
-        t0 = Time('2026-01-01T00:00:00', format='isot', scale='utc')
+    table = tables['pphi']
+    nbeta = table.shape[-1]
+    beta = np.asarray(beta, dtype=float)
+    bad = ~np.isfinite(beta)
+    x = np.clip(np.where(bad, 0, beta), 0, 180)/tables['dbeta']
+    i0 = np.clip(np.floor(x).astype(int), 0, nbeta - 2)
+    t = x - i0
+
+    val = lambda ind: table[band, fe_idx, d_idx, cloud_idx, np.clip(ind, 0, nbeta - 1)]
+    if kind == 'linear':
+        out = (1. - t)*val(i0) + t*val(i0 + 1)
+    elif kind == 'cubic':
+        p0, p1, p2, p3 = val(i0 - 1), val(i0), val(i0 + 1), val(i0 + 2)
+        out = p1 + 0.5*t*(p2 - p0 + t*(2.*p0 - 5.*p1 + 4.*p2 - p3 + t*(3.*(p1 - p2) + p3 - p0)))
+    else:
+        raise ValueError("kind must be 'linear' or 'cubic'.")
 
-    plannames = data['pl_name'].values
-    minWA = data['pl_minangsep'].values*u.mas
-    maxWA = data['pl_maxangsep'].values*u.mas
+    return np.where(bad, np.nan, out)
 
-    photinterps2 = photdict['photinterps']
-    feinterp = photdict['feinterp']
-    distinterp = photdict['distinterp']
-    lambdas = [l for l,band,bw,ws,wstep in bandzip]
 
+class PhotometryModel(object):
+    """
+    Band averaged planet photometry for the grid in photdict (output of
+    loadPhotometryData) and bands in bandzip (output of genBands).
+
+    Calling the model with arrays of metallicity, orbital radius (AU, already
+    luminosity corrected), cloud level (f_sed) and phase angle (deg) returns pPhi.
+    The inputs may be of any mutually broadcastable shapes and in any order; they
+    are mapped to the nearest grid values and looked up in the band tables of
+    getBandTables.  band is the index (or array of indices) into bandzip.
+    """
+
+    def __init__(self, photdict, bandzip, dbeta=0.25, kind='linear'):
+        self.tables = getBandTables(photdict, bandzip, dbeta=dbeta)
+        self.metallicities = photdict['metallicities']
+        self.dists = photdict['dists']
+        self.clouds = photdict['clouds']
+        self.lambdas = self.tables['lambdas']
+        self.kind = kind
 
-    orbdata = None
-    for j in range(len(plannames)):
-        row = data.iloc[j]
-
-        #orbital parameters
-        a = row['pl_orbsmax']
-        e = row['pl_orbeccen']
-        if np.isnan(e): e = 0.0
-        I = row['pl_orbincl']*np.pi/180.0
-        if np.isnan(I): I = np.pi/2.0
-        w = row['pl_orblper']*np.pi/180.0
-        if np.isnan(w): w = 0.0
-        Rp = row['pl_radj_forecastermod']
-        dist = row['st_dist']
-        fe = row['st_metfe']
-        if np.isnan(fe): fe = 0.0
-
-        #time
-        M = np.linspace(0,2*np.pi,100)
-        t = np.zeros(100)*np.nan
-        tau = row['pl_orbtper'] #jd
-        if not np.isnan(tau):
-            Tp = row['pl_orbper'] #days
-            if Tp == 0:
-                Tp = np.nan
-            if np.isnan(Tp):
-                Mstar = row['st_mass'] #solar masses
-                if not np.isnan(Mstar):
-                    mu = const.G*(Mstar*u.solMass).decompose()
-                    Tp = (2*np.pi*np.sqrt(((a*u.AU)**3.0)/mu)).decompose().to(u.d).value
-            if not np.isnan(Tp):
-                n = 2*np.pi/Tp
-                t = np.linspace(t0.jd,t0.jd+Tp,100)
-                M = np.mod((t - tau)*n,2*np.pi)
+    def indices(self, fe, r, cloud):
+        """Grid indices of metallicity, orbital radius and cloud level"""
 
-        #calculate orbital values
-        E = eccanom(M, e)
-        nu = 2*np.arctan(np.sqrt((1.0 + e)/(1.0 - e))*np.tan(E/2.0));
-        d = a*(1.0 - e**2.0)/(1 + e*np.cos(nu))
-        s = d*np.sqrt(4.0*np.cos(2*I) + 4*np.cos(2*nu + 2.0*w) - 2.0*np.cos(-2*I + 2.0*nu + 2*w) - 2*np.cos(2*I + 2*nu + 2*w) + 12.0)/4.0
-        beta = np.arccos(-np.sin(I)*np.sin(nu+w))*u.rad
-
-        WA = np.arctan((s*u.AU)/(dist*u.pc)).to('mas').value
-        print(j,plannames[j],WA.min() - minWA[j].value, WA.max() - maxWA[j].value)
-
-        outdict = {'Name': [plannames[j]]*len(M),
-                    'M': M,
-                    't': t-t0.jd,
-                    'r': d,
-                    's': s,
-                    'WA': WA,
-                    'beta': beta.to(u.deg).value}
-
-        lum = row['st_lum']
-        if np.isnan(lum):
-            lum_fix = 1
-        else:
-            lum_fix = (10 ** lum) ** .5  # Since lum is log base 10 of solar luminosity
+        return (nearestIndex(self.metallicities, fe), nearestIndex(self.dists, r),
+                nearestIndex(self.clouds, cloud))
 
+    def __call__(self, fe, r, cloud, beta, band=0):
+        fei, di, ci = self.indices(fe, r, cloud)
+        return bandPPhi(self.tables, band, fei, di, ci, beta, kind=self.kind)
 
-        alldMags = np.zeros((len(photdict['clouds']), len(lambdas), len(beta)))
-        allpphis = np.zeros((len(photdict['clouds']), len(lambdas), len(beta)))
+    def quad(self, fe, r, cloud, band=0):
+        """Band averaged pPhi at quadrature"""
 
-        inds = np.argsort(beta)
-        for count1,c in enumerate(photdict['clouds']):
-            for count2,(l,band,bw,ws,wstep) in enumerate(bandzip):
-                pphi = (photinterps2[float(feinterp(fe))][float(distinterp(a/lum_fix))][c](beta.to(u.deg).value[inds],ws).sum(1)*wstep/bw)[np.argsort(inds)]
-                pphi[np.isinf(pphi)] = np.nan
-                outdict['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM"] = pphi
-                allpphis[count1,count2] = pphi
-                dMag = deltaMag(1, Rp*u.R_jupiter, d*u.AU, pphi)
-                dMag[np.isinf(dMag)] = np.nan
-                outdict['dMag_'+"%03dC_"%(c*100)+str(l)+"NM"] = dMag
-                alldMags[count1,count2] = dMag
+        fei, di, ci = self.indices(fe, r, cloud)
+        return self.tables['quad'][band, fei, di, ci]
 
 
-        pphismin = np.nanmin(allpphis,axis=0)
-        dMagsmin = np.nanmin(alldMags,axis=0)
-        pphismax = np.nanmax(allpphis,axis=0)
-        dMagsmax = np.nanmax(alldMags,axis=0)
-        pphismed = np.nanmedian(allpphis,axis=0)
-        dMagsmed = np.nanmedian(alldMags,axis=0)
+def genStarTable(data, photdict):
+    """
+    Compute host star quantities once per star for all planets in data (output of
+    getIPACdata) and photometry grid photdict (output of loadPhotometryData).
+
+    Returns a DataFrame with one row per host star (pl_hostname; rows of the same host
+    that disagree on stellar values are kept apart) and an integer array giving the
+    row of each planet's host.  Besides st_dist, st_lum, st_mass and st_metfe the
+    table holds:
+        lum_fix: square root of the luminosity in solar units (1 if unknown), which
+                 scales orbital distances onto the photometry grid
+        mu:      stellar gravitational parameter in AU^3/day^2 (NaN if no mass)
+        fe:      metallicity (0 if unknown)
+        fe_grid: nearest photometry grid metallicity
+    """
 
-        for count3,l in enumerate(lambdas):
-            outdict["dMag_min_"+str(l)+"NM"] = dMagsmin[count3]
-            outdict["dMag_max_"+str(l)+"NM"] = dMagsmax[count3]
-            outdict["dMag_med_"+str(l)+"NM"] = dMagsmed[count3]
-            outdict["pPhi_min_"+str(l)+"NM"] = pphismin[count3]
-            outdict["pPhi_max_"+str(l)+"NM"] = pphismax[count3]
-            outdict["pPhi_med_"+str(l)+"NM"] = pphismed[count3]
+    starcols = ['pl_hostname', 'st_dist', 'st_lum', 'st_mass', 'st_metfe']
+    hostind = data.groupby(starcols, dropna=False, sort=False).ngroup().values
+    first = np.unique(hostind, return_index=True)[1]
+    stars = data[starcols].iloc[first].reset_index(drop=True)
 
-        out = pandas.DataFrame(outdict)
+    lum = stars['st_lum'].values
+    lum_fix = np.ones(len(stars))
+    lum_fix[~np.isnan(lum)] = (10 ** lum[~np.isnan(lum)]) ** .5  # Since lum is log base 10 of solar luminosity
+    stars['lum_fix'] = lum_fix
 
-        if orbdata is None:
-            orbdata = out.copy()
-        else:
-            orbdata = orbdata.append(out)
+    stars['mu'] = (const.G*(stars['st_mass'].values*u.solMass)).to(u.AU**3/u.day**2).value
 
-    return orbdata
+    fe = stars['st_metfe'].values.copy()
+    fe[np.isnan(fe)] = 0.0
+    stars['fe'] = fe
+    stars['fe_grid'] = photdict['feinterp'](fe)
+
+    return stars, hostind
 
 
-def genAltOrbitData(data, bandzip, photdict, t0=None):
+class PlanetParams(object):
+    """
+    Structure of arrays holding the per-planet values used by the orbit, photometry
+    and completeness stages, built once from data (output of getIPACdata) and stars
+    (output of genStarTable, computed from photdict if not given).
+
+    Each attribute is an array with one entry per row of data.  Missing values are
+    already replaced by the defaults the stages assume, with masks recording what
+    was actually measured:
+        name:       planet name
+        a, aerr:    sma and its error (AU; error defaults to 1% of sma)
+        e, eerr:    eccentricity (default 0) and its error (default 1% of e)
+        hase:       eccentricity is known
+        I, Ierr:    inclination (rad; default pi/2) and its error (default 1% of I)
+        hasI:       inclination is known (and not a 90 deg placeholder with zero errors)
+        hasIerr:    inclination error is known
+        w, werr:    argument of periapsis (rad; default 0) and its error (default 1% of w)
+        hasw:       argument of periapsis is known
+        tau:        time of periapsis (JD, NaN if unknown)
+        Tp:         orbital period (days, from the star mass if not given, NaN if neither)
+        Rp:         modified forecaster radius (R_jupiter)
+        R, Rerr:    catalog radius and its error (R_jupiter; error defaults to 10%)
+        calcrad:    catalog radius was calculated from the mass
+        Mp, Mperr:  mass and error (M_earth; error defaults to 10%)
+        msini:      mass is a minimum (Msini) mass
+        Icrit:      minimum inclination for which the mass stays below 0.08 M_sun
+                    (rad; 10 deg if not an Msini mass)
+        dist:       star distance (pc)
+        lum_fix:    star luminosity distance scaling (see genStarTable)
+        fe:         nearest photometry grid metallicity of the star
+    """
+
+    __slots__ = ('name', 'a', 'aerr', 'e', 'eerr', 'hase', 'I', 'Ierr', 'hasI', 'hasIerr',
+                 'w', 'werr', 'hasw', 'tau', 'Tp', 'Rp', 'R', 'Rerr', 'calcrad', 'Mp', 'Mperr',
+                 'msini', 'Icrit', 'dist', 'lum_fix', 'fe')
+
+    def __init__(self, data, photdict=None, stars=None):
+        if stars is None:
+            stars = genStarTable(data, photdict)
+        startab, hostind = stars
+
+        halferr = lambda col: ((data[col+'err1'] - data[col+'err2'])/2.).values
+        deffrac = lambda val, err, frac: np.where(np.isnan(err), frac*val, err)
+
+        self.name = data['pl_name'].values
+
+        self.a = data['pl_orbsmax'].values.astype(float)
+        self.aerr = deffrac(self.a, halferr('pl_orbsmax'), 0.01)
+
+        e = data['pl_orbeccen'].values.astype(float)
+        self.hase = ~np.isnan(e)
+        self.e = np.where(self.hase, e, 0.0)
+        eerr = halferr('pl_orbeccen')
+        self.eerr = deffrac(self.e, np.where(eerr == 0, np.nan, eerr), 0.01)
+
+        I = data['pl_orbincl'].values.astype(float)
+        Ierr1 = data['pl_orbinclerr1'].values
+        Ierr2 = data['pl_orbinclerr2'].values
+        self.hasI = ~np.isnan(I) & ~((I == 90) & (Ierr1 == 0) & (Ierr2 == 0))
+        self.hasIerr = ~np.isnan(Ierr1)
+        self.I = np.where(np.isnan(I), 90.0, I)*np.pi/180.0
+        Ierr = halferr('pl_orbincl')*np.pi/180.0
+        self.Ierr = deffrac(self.I, np.where(Ierr == 0, np.nan, Ierr), 0.01)
+
+        w = data['pl_orblper'].values.astype(float)
+        self.hasw = ~np.isnan(w)
+        self.w = np.where(self.hasw, w, 0.0)*np.pi/180.0
+        werr = halferr('pl_orblper')*np.pi/180.0
+        self.werr = deffrac(self.w, np.where(werr == 0, np.nan, werr), 0.01)
+
+        self.tau = data['pl_orbtper'].values.astype(float)
+        mus = startab['mu'].values[hostind]
+        Tp = data['pl_orbper'].values.astype(float)
+        Tp[Tp == 0] = np.nan
+        self.Tp = np.where(np.isnan(Tp), 2*np.pi*np.sqrt(self.a**3.0/mus), Tp)
+
+        self.Rp = data['pl_radj_forecastermod'].values.astype(float)
+        self.R = data['pl_radj'].values.astype(float)
+        self.Rerr = deffrac(self.R, halferr('pl_radj'), 0.1)
+        self.calcrad = ((data['pl_radreflink'] ==\
+                '<a refstr="CALCULATED VALUE" href="/docs/composite_calc.html" target=_blank>Calculated Value</a>') | \
+                (data['pl_radreflink'] == \
+                '<a refstr=CALCULATED_VALUE href=/docs/composite_calc.html target=_blank>Calculated Value</a>')).values
+
+        self.Mp = ((data['pl_bmassj'].values*u.M_jupiter).to(u.M_earth)).value
+        self.Mperr = deffrac(self.Mp, (((data['pl_bmassjerr1'] - data['pl_bmassjerr2']).values*u.M_jupiter).to(u.M_earth)).value, 0.1)
+        self.msini = (data['pl_bmassprov'] == 'Msini').values
+        self.Icrit = np.full(self.a.size, 10*np.pi/180.0)
+        self.Icrit[self.msini] = np.arcsin(self.Mp[self.msini]/((0.0800*u.M_sun).to(u.M_earth)).value)
+
+        self.dist = startab['st_dist'].values[hostind]
+        self.lum_fix = startab['lum_fix'].values[hostind]
+        self.fe = startab['fe_grid'].values[hostind]
+
+    def __len__(self):
+        return self.a.size
+
+
+def calcQuadratureVals(data, bandzip, photdict, params=None):
+    """
+    Calculate quadrature photometry values for planets in data (output of getIPACdata)
+    for bands in bandzip (output of genBands) assuming photometry info from photdict
+    (output from loadPhotometryData).  params is the PlanetParams of data (built
+    here if not given).
+
+    All planets, cloud levels and bands are evaluated at once, as arrays of shape
+    (planets, clouds, bands).
+    """
+
+    if params is None:
+        params = PlanetParams(data, photdict)
+    P = params
+
+    model = PhotometryModel(photdict, bandzip)
+    clouds = photdict['clouds']
+    lambdas = [l for l,band,bw,ws,wstep in bandzip]
+
+    #broadcasting shapes: planets x 1 x 1, clouds x 1 and bands
+    fe = P.fe[:,None,None]
+    cs = clouds[:,None]
+    bands = np.arange(len(lambdas))
+    Rp = P.Rp[:,None,None]
+
+    #default: circular orbit at the semi-major axis
+    r0 = P.a/P.lum_fix
+    pphi = model.quad(fe, r0[:,None,None], cs, band=bands)
+    dMag = deltaMagnitude(Rp, P.a[:,None,None], pphi)
+    radius = np.tile(r0[:,None,None], pphi.shape[1:])
+
+    #Only calculate quadrature distance if known eccentricity and argument of periaps,
+    #and not face-on orbit.  Of the two quadratures, keep the brighter one.
+    inds = np.where(P.hase & P.hasw & (P.I != 0))[0]
+    if inds.size > 0:
+        a = P.a[inds]
+        e = P.e[inds]
+        w = P.w[inds]
+        r1 = (a*(1.0 - e**2.0)/(1.0 + e*np.cos(-w))/P.lum_fix[inds])[:,None,None]
+        r2 = (a*(1.0 - e**2.0)/(1.0 + e*np.cos(np.pi - w))/P.lum_fix[inds])[:,None,None]
+
+        pphi1 = model.quad(fe[inds], r1, cs, band=bands)
+        pphi2 = model.quad(fe[inds], r2, cs, band=bands)
+        dMag1 = deltaMagnitude(Rp[inds], r1, pphi1)
+        dMag2 = deltaMagnitude(Rp[inds], r2, pphi2)
+
+        use1 = np.isnan(dMag2) | (dMag1 < dMag2)
+        pphi[inds] = np.where(use1, pphi1, pphi2)
+        dMag[inds] = np.where(use1, dMag1, dMag2)
+        radius[inds] = np.where(use1, r1, r2)
+
+    dMag[np.isinf(dMag)] = np.nan
+
+    tmpout = {}
+    for count1,c in enumerate(clouds):
+        for count2,l in enumerate(lambdas):
+            tmpout['quad_pPhi_'+"%03dC_"%(c*100)+str(l)+"NM"] = pphi[:,count1,count2]
+            tmpout['quad_dMag_'+"%03dC_"%(c*100)+str(l)+"NM"] = dMag[:,count1,count2]
+            tmpout['quad_radius_' + "%03dC_" % (c * 100) + str(l) + "NM"] = radius[:,count1,count2]
+
+    for count2,l in enumerate(lambdas):
+        tmpout["quad_dMag_min_"+str(l)+"NM"] = np.nanmin(dMag[:,:,count2],axis=1)
+        tmpout["quad_dMag_max_"+str(l)+"NM"] = np.nanmax(dMag[:,:,count2],axis=1)
+        tmpout["quad_dMag_med_"+str(l)+"NM"] = np.nanmedian(dMag[:,:,count2],axis=1)
+
+    data = data.join(pandas.DataFrame(tmpout))
+
+    return data
+
+
+def nanMedian(vals, axis=0):
+    """
+    Median of vals along axis ignoring NaNs, as np.nanmedian, but via a single sort
+    (NaNs sort last) rather than masked arrays, which is much faster for the short
+    axes (cloud levels) used here.  All-NaN slices give NaN without a warning.
+    """
+
+    vals = np.sort(vals, axis=axis)
+    n = np.sum(~np.isnan(vals), axis=axis, keepdims=True)
+    lo = np.take_along_axis(vals, np.maximum(n - 1, 0)//2, axis=axis)
+    hi = np.take_along_axis(vals, n//2 - (n == 0), axis=axis)
+    med = (lo + hi)/2
+    med[n == 0] = np.nan
+
+    return np.squeeze(med, axis=axis)
+
+
+def orbitSampleNodes(params, model, clouds, watol=2.5e-3, dmagtol=0.03, ntmin=16, ntmax=200):
+    """
+    Adaptive eccentric anomaly samples of one orbit of each planet in params
+    (PlanetParams), aiming for linear interpolation in mean anomaly (or time)
+    between samples to reproduce the working angle to within watol (as a fraction
+    of the working angle at apoapsis) and dMag (for all cloud levels in clouds, in
+    the first band of PhotometryModel model) to within dmagtol.
+
+    Starting from ntmin samples evenly spaced in E (which already concentrates them
+    near periapsis), every interval where interpolation misses either tolerance at
+    its midpoint or quarter points is bisected, for all planets at once, until all
+    intervals pass.  Planets are capped at ntmax samples, keeping the worst
+    intervals.  Non-finite dMags (e.g. at new phase) are not tested.  The
+    tolerances are only checked at these test points, so the error in between can
+    be somewhat larger, mostly near the kink in working angle where a nearly edge-on
+    orbit passes in front of or behind the star.
+
+    Returns the samples in [0, 2pi) of all planets concatenated in order, and the
+    number of samples of each planet.
+    """
+
+    P = params
+    nplan = len(P)
+    A, B = orbitVectors(P.a, P.e, P.I, P.w)
+    rnorm = P.a/P.lum_fix
+    #working angle scale: separation at apoapsis
+    wascale = workingAngle(P.a*(1 + P.e), P.dist)
+
+    def evalNodes(E, p):
+        """M, scaled WA and dMags (clouds x samples) at E for planets p"""
+        e = P.e[p]
+        sinE = np.sin(E)
+        cosE = np.cos(E)
+        r = orbitPosition(A[:,p], B[:,p], e, sinE, cosE)
+        d = P.a[p]*(1.0 - e*cosE)
+        beta = phaseAngleFromPosition(r[2], d, deg=True)
+        WA = workingAngle(np.hypot(r[0], r[1]), P.dist[p])/wascale[p]
+        dMag = np.vstack([deltaMagnitude(P.Rp[p], d, model(P.fe[p], rnorm[p], c, beta)) for c in clouds])
+        dMag[~np.isfinite(dMag)] = np.nan
+        return E - e*sinE, WA, dMag
+
+    #initial grid, including the closing sample at 2pi
+    E = np.tile(np.linspace(0, 2*np.pi, ntmin), nplan)
+    p = np.repeat(np.arange(nplan), ntmin)
+    M, WA, dMag = evalNodes(E, p)
+    #intervals to test, by index of their left sample
+    check = np.ones(E.size, dtype=bool)
+    check[ntmin-1::ntmin] = False
+
+    while np.any(check):
+        il = np.where(check)[0]
+        pm = p[il]
+        #test points at the midpoint (first) and the quarter points of each interval
+        it = np.tile(il, 3)
+        Et = E[it] + (E[it+1] - E[it])*np.repeat([0.5, 0.25, 0.75], il.size)
+        Mt, WAt, dMagt = evalNodes(Et, p[it])
+
+        #error of linear interpolation in M at the test points
+        frac = (Mt - M[it])/(M[it+1] - M[it])
+        errwa = np.abs(WAt - WA[it] - (WA[it+1] - WA[it])*frac)
+        errdm = np.abs(dMagt - dMag[:,it] - (dMag[:,it+1] - dMag[:,it])*frac)
+        errdm = np.fmax.reduce(errdm, axis=0)
+        errdm[np.isnan(errdm)] = 0
+        err = np.maximum(errwa/watol, errdm/dmagtol).reshape(3, il.size).max(axis=0)
+        split = err > 1
+        Em = Et[:il.size]
+        Mm = Mt[:il.size]
+        WAm = WAt[:il.size]
+        dMagm = dMagt[:,:il.size]
+
+        #keep the worst intervals of planets that would exceed ntmax
+        counts = np.bincount(p, minlength=nplan) - 1
+        order = np.lexsort((-err, pm))
+        rank = np.empty(il.size, dtype=int)
+        rank[order] = np.arange(il.size) - np.searchsorted(pm[order], pm[order])
+        split &= rank < ntmax - counts[pm]
+        if not np.any(split):
+            break
+
+        #insert the midpoints of split intervals and test both halves next
+        E = np.hstack((E, Em[split]))
+        order = np.lexsort((E, np.hstack((p, pm[split]))))
+        isnew = np.hstack((np.zeros(p.size, dtype=bool), np.ones(split.sum(), dtype=bool)))[order]
+        E = E[order]
+        p = np.hstack((p, pm[split]))[order]
+        M = np.hstack((M, Mm[split]))[order]
+        WA = np.hstack((WA, WAm[split]))[order]
+        dMag = np.hstack((dMag, dMagm[:,split]))[:,order]
+        check = isnew | np.roll(isnew, -1)
+        check[np.hstack((p[1:] != p[:-1], True))] = False
+
+    #drop the closing samples
+    keep = np.hstack((p[1:] == p[:-1], False))
+
+    return E[keep], np.bincount(p[keep], minlength=nplan)
+
+
+def genOrbitData(data, bandzip, photdict, t0=None, params=None, watol=2.5e-3, dmagtol=0.03,
+                 ntmin=16, ntmax=200):
     """ Generate data for one orbital period starting at absolute time t0 (if time
     of periapsis is known) for all planets in data (output of getIPACdata)
     based on photometric data in photdict (output of loadPhotometryData) for bands
-    in bandzip (output of genBands) for varying values of inclination.
+    in bandzip (output of genBands).  params is the PlanetParams of data (built
+    here if not given).
+
+    Each orbit is sampled adaptively (see orbitSampleNodes) so that linear
+    interpolation in time between rows reproduces WA to within watol (fraction of
+    the WA at apoapsis) and dMag to within dmagtol, with between ntmin and ntmax
+    samples per orbit (plus the closing sample, and the sample at t0 if the time of
+    periapsis is known).  The samples are placed in eccentric anomaly once per
+    planet.  Orbits with known time of periapsis start at t0 and end one period
+    later, and all others run from mean anomaly 0 to 2pi.  The number of samples
+    of each planet is in column nt, and the index counts the samples of each
+    planet.
+
+    t0 may also be an array Time of several epochs (e.g. a sweep over mission start
+    dates), in which case all epochs are returned in one table with an Epoch column
+    (JD of the epoch), with rows ordered by epoch, planet and time.  The orbit
+    samples, projection vectors (orbitVectors) and other per planet constants are
+    computed once, and planets without a known time of periapsis (whose orbits do
+    not depend on t0) are computed once and copied to all epochs.
+
+    The samples of all planets are concatenated (with per planet offsets) and
+    computed at once for each epoch, directly into a single preallocated block that
+    becomes the output DataFrame.
     """
 
     if t0 is None:
         t0 = Time('2026-01-01T00:00:00', format='isot', scale='utc')
+    t0s = np.atleast_1d(t0.jd)
+    nep = t0s.size
 
     plannames = data['pl_name'].values
-    photinterps2 = photdict['photinterps']
-    feinterp = photdict['feinterp']
-    distinterp = photdict['distinterp']
-
-    Isglob = np.array([90,60,30])
-    (l,band,bw,ws,wstep) = bandzip[0]
-    c = 3.0
-
-    altorbdata = None
-    for j in range(len(plannames)):
-        row = data.iloc[j]
-        print("%d/%d  %s"%(j+1,len(plannames),plannames[j]))
-
-
-        #if there is an inclination error, then we're going to skip the row altogether
-        if not(np.isnan(row['pl_orbinclerr1'])) and not(np.isnan(row['pl_orbinclerr1'])):
-            continue
+    model = PhotometryModel(photdict, bandzip)
+    clouds = photdict['clouds']
+    lambdas = [l for l,band,bw,ws,wstep in bandzip]
 
+    if params is None:
+        params = PlanetParams(data, photdict)
+    P = params
+    nplan = len(P)
+
+    #per planet constants, independent of time
+    timed = np.isfinite(P.tau) & np.isfinite(P.Tp)
+    A, B = orbitVectors(P.a, P.e, P.I, P.w)
+    rnorm = P.a/P.lum_fix
+
+    #orbit samples: the adaptive nodes plus the closing sample at 2pi, and for timed
+    #planets the sample at t0
+    nodes, nnodes = orbitSampleNodes(P, model, clouds, watol=watol, dmagtol=dmagtol,
+                                     ntmin=ntmin, ntmax=ntmax)
+    nts = nnodes + 1 + timed
+    offsets = np.hstack((0, np.cumsum(nts)))
+    plan = np.repeat(np.arange(nplan), nts) #planet of each sample
+    k = np.arange(offsets[-1]) - offsets[plan] #sample number within planet
+    nodeplan = np.repeat(np.arange(nplan), nnodes)
+    noderow = offsets[nodeplan] + np.arange(nodes.size) - np.repeat(np.cumsum(nnodes) - nnodes, nnodes)
+    noderow += timed[nodeplan]
+
+    #output columns (other than Name) and the block holding them
+    cols = ['M','t','r','s','WA','beta']
+    if not t0.isscalar:
+        cols = ['Epoch'] + cols
+    for c in clouds:
+        for l in lambdas:
+            cols += ['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM", 'dMag_'+"%03dC_"%(c*100)+str(l)+"NM"]
+    for l in lambdas:
+        cols += [stat+str(l)+"NM" for stat in ['dMag_min_','dMag_max_','dMag_med_','pPhi_min_','pPhi_max_','pPhi_med_']]
+    colind = dict((col,j) for j,col in enumerate(cols))
+    block = np.empty((len(cols),nep,offsets[-1]))
+
+    def fillOrbits(blk, rows, jd):
+        """fill blk (columns x samples) with samples rows, for orbits starting at epoch jd"""
+
+        out = lambda col: blk[colind[col]]
+
+        #eccentric anomaly of each sample.  Timed orbits start from the eccentric
+        #anomaly E0 at t0, with the nodes rotated to follow it.
+        E = np.empty(offsets[-1])
+        E[noderow] = nodes
+        E[offsets[1:] - 1] = 2*np.pi
+        tinds = np.where(timed)[0]
+        if tinds.size > 0:
+            M0 = np.mod((jd - P.tau[tinds])*(2*np.pi/P.Tp[tinds]),2*np.pi)
+            E0 = keplerSolve(M0, P.e[tinds])
+            E[offsets[tinds]] = E0
+            E[offsets[tinds+1] - 1] = E0 + 2*np.pi
+            tnodes = timed[nodeplan]
+            Ent = nodes[tnodes]
+            Ent = Ent + 2*np.pi*(Ent < E0[np.searchsorted(tinds, nodeplan[tnodes])])
+            E[noderow[tnodes]] = Ent[np.lexsort((Ent, nodeplan[tnodes]))]
+        sinE = np.sin(E)
+        cosE = np.cos(E)
+
+        #time: one period starting at t0 if the time of periapsis is known, otherwise
+        #mean anomalies from 0 to 2pi
+        M = E - P.e[plan]*sinE
+        t = np.full(M.size, np.nan)
+        tp = timed[plan]
+        t[tp] = (M - M[offsets[plan]])[tp]*(P.Tp[plan][tp]/(2*np.pi))
+        M[tp] = np.mod(M[tp],2*np.pi)
+        out('M')[:] = M[rows]
+        out('t')[:] = t[rows]
 
-        if row['pl_bmassprov'] == 'Msini':
-                Icrit = np.arcsin( ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value/((0.0800*u.M_sun).to(u.M_earth)).value )
-        else:
-            Icrit = 10*np.pi/180.0
-
-        Is = np.hstack((Isglob*np.pi/180.0,Icrit))
-
-        #orbital parameters
-        a = row['pl_orbsmax']
-        e = row['pl_orbeccen']
-        if np.isnan(e): e = 0.0
-        w = row['pl_orblper']*np.pi/180.0
-        if np.isnan(w): w = 0.0
-        Rp = row['pl_radj_forecastermod']
-        dist = row['st_dist']
-        fe = row['st_metfe']
-        if np.isnan(fe): fe = 0.0
-
-        #time
-        Tp = row['pl_orbper'] #days
-        Mstar = row['st_mass'] #solar masses
-        tau = row['pl_orbtper']
-
-        if np.isnan(Tp) or (Tp == 0.0):
-            if np.isnan(Mstar):
-                continue
-            mu = const.G*(Mstar*u.solMass).decompose()
-            Tp = (2*np.pi*np.sqrt(((a*u.AU)**3.0)/mu)).decompose().to(u.d).value
-
-        n = 2*np.pi/Tp
-        if Tp > 10*365.25:
-            tend = 10*365.25
-        else:
-            tend = Tp
-        t = np.arange(t0.jd,t0.jd+tend,30)
-        if np.isnan(tau):
-            tau = 0.0
-        M = np.mod((t - tau)*n,2*np.pi)
-
-        E = eccanom(M, e)
-        nu = 2*np.arctan(np.sqrt((1.0 + e)/(1.0 - e))*np.tan(E/2.0));
-        d = a*(1.0 - e**2.0)/(1 + e*np.cos(nu))
-
-        outdict = {'Name': [plannames[j]]*len(M),
-                    'M': M,
-                    't': t-t0.jd,
-                    'r': d,
-                    'Icrit': [Icrit]*len(M)
-                   }
-
-        lum = row['st_lum']
-        if np.isnan(lum):
-            lum_fix = 1
-        else:
-            lum_fix = (10 ** lum) ** .5  # Since lum is log base 10 of solar luminosity
+        #calculate orbital values
+        pinds = plan[rows]
+        e = P.e[pinds]
+        sinE = sinE[rows]
+        cosE = cosE[rows]
+        r = orbitPosition(A[:,pinds], B[:,pinds], e, sinE, cosE)
+        d = out('r')
+        np.multiply(P.a[pinds], 1.0 - e*cosE, out=d)
+        np.hypot(r[0], r[1], out=out('s'))
+        phaseAngleFromPosition(r[2], d, deg=True, out=out('beta'))
+        workingAngle(out('s'), P.dist[pinds], out=out('WA'))
+
+        #pPhi and dMag for each cloud and band, all samples at once
+        fe = P.fe[pinds]
+        rn = rnorm[pinds]
+        Rp = P.Rp[pinds]
+        for count2,l in enumerate(lambdas):
+            pcols = [colind['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM"] for c in clouds]
+            dcols = [colind['dMag_'+"%03dC_"%(c*100)+str(l)+"NM"] for c in clouds]
+            for count1,c in enumerate(clouds):
+                pphi = blk[pcols[count1]]
+                pphi[:] = model(fe, rn, c, out('beta'), band=count2)
+                dMag = deltaMagnitude(Rp, d, pphi, out=blk[dcols[count1]])
+                dMag[np.isinf(dMag)] = np.nan
 
-        for k,I in enumerate(Is):
-            s = d * np.sqrt(4.0 * np.cos(2 * I) + 4 * np.cos(2 * nu + 2.0 * w) - 2.0 * np.cos(-2 * I + 2.0 * nu + 2 * w) - 2 * np.cos(2 * I + 2 * nu + 2 * w) + 12.0) / 4.0
-            beta = np.arccos(-np.sin(I) * np.sin(nu + w)) * u.rad
+            #the cloud columns of a band are evenly spaced in the block, so take views
+            pphis = blk[pcols[0]:pcols[-1]+1:2*len(lambdas)]
+            dMags = blk[dcols[0]:dcols[-1]+1:2*len(lambdas)]
+            #samples with no valid photometry in any cloud level stay NaN, quietly
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                np.nanmin(dMags, axis=0, out=out("dMag_min_"+str(l)+"NM"))
+                np.nanmax(dMags, axis=0, out=out("dMag_max_"+str(l)+"NM"))
+                np.nanmin(pphis, axis=0, out=out("pPhi_min_"+str(l)+"NM"))
+                np.nanmax(pphis, axis=0, out=out("pPhi_max_"+str(l)+"NM"))
+            out("dMag_med_"+str(l)+"NM")[:] = nanMedian(dMags)
+            out("pPhi_med_"+str(l)+"NM")[:] = nanMedian(pphis)
+
+    #all planets at the first epoch, then only the planets with known time of
+    #periapsis at the others, one epoch at a time in a reused work block
+    fillOrbits(block[:,0], slice(None), t0s[0])
+    if nep > 1:
+        trows = timed[plan]
+        work = np.empty((len(cols),trows.sum()))
+        for j in range(1,nep):
+            fillOrbits(work, trows, t0s[j])
+            block[:,j,trows] = work
+            block[:,j,~trows] = block[:,0,~trows]
+    if 'Epoch' in colind:
+        block[colind['Epoch']] = t0s[:,None]
+
+    orbdata = pandas.DataFrame(block.reshape(len(cols),-1).T, columns=cols,
+                               index=np.tile(k,nep), copy=False)
+    orbdata.insert(0, 'Name', np.tile(plannames[plan],nep))
+    orbdata['nt'] = np.tile(nts[plan],nep)
+    print("Generated %d orbits (%d samples each on average) at %d epoch(s)."%(nplan,np.round(nts.mean()),nep))
 
-            WA = np.arctan((s*u.AU)/(dist*u.pc)).to('mas').value
+    return orbdata
 
-            if I == Icrit:
-                Itag = "crit"
-            else:
-                Itag = "%02d"%(Isglob[k])
 
-            outdict["s_I"+Itag] = s
-            outdict["WA_I"+Itag] =  WA
-            outdict["beta_I"+Itag] = beta.to(u.deg).value
+def genAltOrbitData(data, bandzip, photdict, t0=None, params=None, clouds=(3.0,)):
+    """ Generate data for one orbital period starting at absolute time t0 (if time
+    of periapsis is known) for all planets in data (output of getIPACdata)
+    based on photometric data in photdict (output of loadPhotometryData) for bands
+    in bandzip (output of genBands) and cloud levels clouds, for varying values of
+    inclination.  params is the PlanetParams of data (built here if not given).
+
+    Planets are sampled every 30 days for up to 10 years, so they have different
+    numbers of samples.  The samples of all planets are concatenated (with per
+    planet offsets) and all inclinations and bands are computed at once, directly
+    into a single preallocated block that becomes the output DataFrame.  The index
+    counts the samples of each planet.
+
+    As for genOrbitData, t0 may be an array Time of several epochs, in which case
+    all epochs are computed at once (the time grids do not depend on t0) and an
+    Epoch column (JD of the epoch) is added, with rows ordered by epoch, planet and
+    time.
+    """
 
-            inds = np.argsort(beta)
-            pphi = (photinterps2[float(feinterp(fe))][float(distinterp(a / lum_fix))][c](beta.to(u.deg).value[inds],ws).sum(1)*wstep/bw)[np.argsort(inds)]
-            pphi[np.isinf(pphi)] = np.nan
-            outdict['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag] = pphi
-            dMag = deltaMag(1, Rp*u.R_jupiter, d*u.AU, pphi)
-            dMag[np.isinf(dMag)] = np.nan
-            outdict['dMag_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag] = dMag
+    if t0 is None:
+        t0 = Time('2026-01-01T00:00:00', format='isot', scale='utc')
+    t0s = np.atleast_1d(t0.jd)
+    nep = t0s.size
 
+    plannames = data['pl_name'].values
+    model = PhotometryModel(photdict, bandzip)
+    lambdas = [l for l,band,bw,ws,wstep in bandzip]
 
-        out = pandas.DataFrame(outdict)
+    if params is None:
+        params = PlanetParams(data, photdict)
+    P = params
 
-        if altorbdata is None:
-            altorbdata = out.copy()
-        else:
-            altorbdata = altorbdata.append(out)
+    Isglob = np.array([90,60,30])
+    Itags = ["%02d"%I for I in Isglob] + ["crit"]
+
+    #if there is an inclination error (or no period), skip the planet altogether
+    pinds = np.where(~P.hasIerr & np.isfinite(P.Tp))[0]
+    if pinds.size == 0:
+        return None
+
+    #time grids: every 30 days for one period, up to 10 years
+    Tp = P.Tp[pinds] #days
+    tend = np.where(Tp > 10*365.25, 10*365.25, Tp)
+    counts = np.ceil(tend/30).astype(int)
+    offsets = np.hstack((0, np.cumsum(counts)))
+    plan = np.repeat(np.arange(pinds.size), counts) #planet of each sample
+    k = np.arange(offsets[-1]) - offsets[plan] #sample number within planet
+    pinds = np.tile(pinds[plan], nep)
+    k = np.tile(k, nep)
+    jd = np.repeat(t0s, offsets[-1]) #epoch of each sample
+
+    #output columns (other than Name) and the block holding them
+    cols = ['M','t','r','Icrit']
+    if not t0.isscalar:
+        cols = ['Epoch'] + cols
+    for Itag in Itags:
+        cols += ["s_I"+Itag, "WA_I"+Itag, "beta_I"+Itag]
+        for c in clouds:
+            for l in lambdas:
+                cols += ['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag, 'dMag_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag]
+    colind = dict((col,j) for j,col in enumerate(cols))
+    block = np.empty((len(cols),pinds.size))
+    out = lambda col: block[colind[col]]
+
+    t = jd + k*30.
+    tau = P.tau[pinds]
+    tau[np.isnan(tau)] = 0.0
+    M = out('M')
+    np.mod((t - tau)*(2*np.pi/P.Tp[pinds]),2*np.pi, out=M)
+    out('t')[:] = t - jd
+    if 'Epoch' in colind:
+        out('Epoch')[:] = jd
+    out('Icrit')[:] = P.Icrit[pinds]
+
+    e = P.e[pinds]
+    w = P.w[pinds]
+    E, nu = keplerSolve(M, e, trueanom=True)
+    d = out('r')
+    d[:] = P.a[pinds]*(1.0 - e**2.0)/(1 + e*np.cos(nu))
+
+    #all inclinations at once: (inclinations x samples)
+    Is = np.vstack([np.full(pinds.size, I*np.pi/180.0) for I in Isglob] + [P.Icrit[pinds]])
+    sinds = [colind["s_I"+Itag] for Itag in Itags]
+    binds = [colind["beta_I"+Itag] for Itag in Itags]
+    s = projectedSeparation(d, Is, nu, w)
+    beta = phaseAngle(Is, nu, w, deg=True)
+    block[sinds] = s
+    block[binds] = beta
+    block[[colind["WA_I"+Itag] for Itag in Itags]] = workingAngle(s, P.dist[pinds])
+
+    #all bands x inclinations at once for each cloud level
+    fe = P.fe[pinds]
+    r = P.a[pinds]/P.lum_fix[pinds]
+    for c in clouds:
+        pphi = model(fe, r, c, beta, band=np.arange(len(lambdas))[:,None,None])
+        dMag = deltaMagnitude(P.Rp[pinds], d, pphi)
+        dMag[np.isinf(dMag)] = np.nan
+        for count2,l in enumerate(lambdas):
+            block[[colind['pPhi_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag] for Itag in Itags]] = pphi[count2]
+            block[[colind['dMag_'+"%03dC_"%(c*100)+str(l)+"NM_I"+Itag] for Itag in Itags]] = dMag[count2]
+
+    altorbdata = pandas.DataFrame(block.T, columns=cols, index=k, copy=False)
+    altorbdata.insert(0, 'Name', plannames[pinds])
+    print("Generated alternate inclination orbits for %d planets at %d epoch(s)."%(offsets.size-1,nep))
 
     return altorbdata
 
@@ -937,16 +2104,19 @@ def get_fsed(num):
     return float(r)
 
 
-def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,contrfile='WFIRST_pred_imaging.txt'):
+def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,contrfile='WFIRST_pred_imaging.txt',
+                           params=None):
     """ For all known planets in data (output from getIPACdata), calculate obscurational
     and photometric completeness for those cases where obscurational completeness is
-    non-zero.
+    non-zero.  params is the PlanetParams of data (built here if not given).
     """
 
     (l,band,bw,ws,wstep) = bandzip[0]
-    photinterps2 = photdict['photinterps']
-    feinterp = photdict['feinterp']
-    distinterp = photdict['distinterp']
+    model = PhotometryModel(photdict, bandzip)
+
+    if params is None:
+        params = PlanetParams(data, photdict)
+    P = params
 
     wfirstcontr = np.genfromtxt(contrfile)
     contr = wfirstcontr[:,1]
@@ -985,30 +2155,27 @@ def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,
     cs = []
     goodinds = []
     for i,j in enumerate(inds):
-        row = data.iloc[j]
-        print("%d/%d  %s"%(i+1,len(inds),row['pl_name']))
+        print("%d/%d  %s"%(i+1,len(inds),P.name[j]))
 
         #sma distribution
-        amu = row['pl_orbsmax']
-        astd = (row['pl_orbsmaxerr1'] - row['pl_orbsmaxerr2'])/2.
-        if np.isnan(astd): astd = 0.01*amu
+        amu = P.a[j]
+        astd = P.aerr[j]
         gena = lambda n: np.clip(np.random.randn(n)*astd + amu,0,np.inf)
 
         #eccentricity distribution
-        emu = row['pl_orbeccen']
-        if np.isnan(emu):
-            gene = lambda n: 0.175/np.sqrt(np.pi/2.)*np.sqrt(-2.*np.log(1 - np.random.uniform(size=n)))
+        emu = P.e[j]
+        if not P.hase[j]:
+            #Rayleigh, clipped like the known eccentricity draws as keplerSolve needs e < 1
+            gene = lambda n: np.clip(0.175/np.sqrt(np.pi/2.)*np.sqrt(-2.*np.log(1 - np.random.uniform(size=n))),0,0.99)
         else:
-            estd = (row['pl_orbeccenerr1'] - row['pl_orbeccenerr2'])/2.
-            if np.isnan(estd) or (estd == 0):
-                estd = 0.01*emu
+            estd = P.eerr[j]
             gene = lambda n: np.clip(np.random.randn(n)*estd + emu,0,0.99)
 
         #inclination distribution
-        Imu = row['pl_orbincl']*np.pi/180.0
-        if np.isnan(Imu) or ((row['pl_orbincl'] == 90) and (row['pl_orbinclerr1'] == 0) and (row['pl_orbinclerr2'] == 0)): #Generates full sinusoidal distribution if 90 incl 0 errors
-            if row['pl_bmassprov'] == 'Msini':
-                Icrit = np.arcsin( ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value/((0.0800*u.M_sun).to(u.M_earth)).value )
+        Imu = P.I[j]
+        if not P.hasI[j]: #Generates full sinusoidal distribution if 90 incl 0 errors
+            if P.msini[j]:
+                Icrit = P.Icrit[j]
                 Irange = [Icrit, np.pi - Icrit]
                 C = 0.5*(np.cos(Irange[0])-np.cos(Irange[1]))
                 genI = lambda n: np.arccos(np.cos(Irange[0]) - 2.*C*np.random.uniform(size=n))
@@ -1016,24 +2183,19 @@ def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,
             else:
                 genI = lambda n: np.arccos(1 - 2.*np.random.uniform(size=n))
         else:
-            Istd = (row['pl_orbinclerr1'] - row['pl_orbinclerr2'])/2.*np.pi/180.0
-            if np.isnan(Istd) or (Istd == 0):
-                Istd = Imu*0.01
+            Istd = P.Ierr[j]
             genI = lambda n: np.random.randn(n)*Istd + Imu
 
         #arg. of periastron distribution
-        wmu = row['pl_orblper']*np.pi/180.0
-        if np.isnan(wmu):
+        wmu = P.w[j]
+        if not P.hasw[j]:
             genw = lambda n: np.random.uniform(size=n,low=0.0,high=2*np.pi)
         else:
-            wstd = (row['pl_orblpererr1'] - row['pl_orblpererr2'])/2.*np.pi/180.0
-            if np.isnan(wstd) or (wstd == 0):
-                wstd = wmu*0.01
+            wstd = P.werr[j]
             genw = lambda n: np.random.randn(n)*wstd + wmu
 
         #just a single metallicity
-        fe = row['st_metfe']
-        if np.isnan(fe): fe = 0.0
+        fe = P.fe[j]
 
         #initialize loops vars
         n = int(1e6)
@@ -1056,55 +2218,34 @@ def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,
             cl = vget_fsed(np.random.rand(n))
 
             #define mass/radius distribution depending on data provenance
-            if ((row['pl_radreflink'] ==\
-                    '<a refstr="CALCULATED VALUE" href="/docs/composite_calc.html" target=_blank>Calculated Value</a>') | \
-                    (row['pl_radreflink'] == \
-                    '<a refstr=CALCULATED_VALUE href=/docs/composite_calc.html target=_blank>Calculated Value</a>')):
-                if row['pl_bmassprov'] == 'Msini':
-                    Mp = ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value
-                    Mp = Mp/np.sin(I)
+            if P.calcrad[j]:
+                if P.msini[j]:
+                    Mp = P.Mp[j]/np.sin(I)
                 else:
-                    Mstd = (((row['pl_bmassjerr1'] - row['pl_bmassjerr2'])*u.M_jupiter).to(u.M_earth)).value
-                    if np.isnan(Mstd):
-                        Mstd = ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value * 0.1
-                    Mp = np.random.randn(n)*Mstd + ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value
+                    Mp = np.random.randn(n)*P.Mperr[j] + P.Mp[j]
 
                 R = (RfromM(Mp)*u.R_earth).to(u.R_jupiter).value
                 R[R > 1.0] = 1.0
             else:
-                Rmu = row['pl_radj']
-                Rstd = (row['pl_radjerr1'] - row['pl_radjerr2'])/2.
-                if np.isnan(Rstd): Rstd = Rmu*0.1
+                Rmu = P.R[j]
+                Rstd = P.Rerr[j]
                 R = np.random.randn(n)*Rstd + Rmu
 
             M0 = np.random.uniform(size=n,low=0.0,high=2*np.pi)
-            E = eccanom(M0, e)
-            nu = 2*np.arctan(np.sqrt((1+e)/(1-e))*np.tan(E/2))
+            E, nu = keplerSolve(M0, e, trueanom=True)
 
             d = a * (1.0 - e ** 2.0) / (1 + e * np.cos(nu))
-            s = d * np.sqrt(4.0 * np.cos(2 * I) + 4 * np.cos(2 * nu + 2.0 * w) - 2.0 * np.cos(-2 * I + 2.0 * nu + 2 * w) - 2 * np.cos(2 * I + 2 * nu + 2 * w) + 12.0) / 4.0
-            beta = np.arccos(-np.sin(I) * np.sin(nu + w)) * u.rad
+            s = projectedSeparation(d, I, nu, w)
+            beta = phaseAngle(I, nu, w, deg=True)
             rnorm = d
 
-            lum = row['st_lum']
-
-            if np.isnan(lum):
-                lum_fix = 1
-            else:
-                lum_fix = (10 ** lum) ** .5  # Since lum is log base 10 of solar luminosity
+            lum_fix = P.lum_fix[j]
 
-            pphi = np.zeros(n)
-            for clevel in np.unique(cl):
-                tmpinds = cl == clevel
-                betatmp = beta[tmpinds]
-                binds = np.argsort(betatmp)
-                pphi[tmpinds] = (photinterps2[float(feinterp(fe))][float(distinterp(np.mean(rnorm) / lum_fix))][clevel](betatmp.to(u.deg).value[binds],ws).sum(1)*wstep/bw)[np.argsort(binds)].flatten()
-
-            pphi[np.isinf(pphi)] = np.nan
+            pphi = model(fe, np.mean(rnorm)/lum_fix, cl, beta)
             pphi[pphi <= 0.0] = 1e-16
 
-            dMag = deltaMag(1, R*u.R_jupiter, rnorm*u.AU, pphi)
-            WA = np.arctan((s*u.AU)/(row['st_dist']*u.pc)).to('mas').value # working angle
+            dMag = deltaMagnitude(R, rnorm, pphi)
+            WA = workingAngle(s, P.dist[j]) # working angle
 
             h += np.histogram2d(WA,dMag,bins=(WAbins,dMagbins))[0][1:-1,0:-1]
             k += 1.0
@@ -1131,7 +2272,7 @@ def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,
 
         if c != 0.0:
             h = h/float(n*k)
-            names.append(np.array([row['pl_name']]*h.size))
+            names.append(np.array([P.name[j]]*h.size))
             WAcs.append(WAc.flatten())
             dMagcs.append(dMagc.flatten())
             hs.append(h.flatten())
@@ -1143,14 +2284,17 @@ def calcPlanetCompleteness(data, bandzip, photdict, minangsep=150,maxangsep=450,
         print("\n\n\n\n")
 
     cs = np.array(cs)
-    goodinds = np.array(goodinds)
-
-    out2 = pandas.DataFrame({'Name': np.hstack(names),
-                             'alpha': np.hstack(WAcs),
-                             'dMag': np.hstack(dMagcs),
-                             'H':    np.hstack(hs),
-                             'iind': np.hstack(iinds),
-                             'jind': np.hstack(jinds)
+    goodinds = np.array(goodinds, dtype=int)
+
+    #no planet may have non-zero completeness (e.g. an incremental run where no
+    #changed planet is in range), giving an empty table
+    stack = lambda vals, dtype: np.hstack(vals) if len(vals) > 0 else np.array([], dtype=dtype)
+    out2 = pandas.DataFrame({'Name': stack(names, str),
+                             'alpha': stack(WAcs, float),
+                             'dMag': stack(dMagcs, float),
+                             'H':    stack(hs, float),
+                             'iind': stack(iinds, int),
+                             'jind': stack(jinds, int)
                              })
     out2 = out2[out2['H'].values != 0.]
     out2['H'] = np.log10(out2['H'].values)
@@ -1201,7 +2345,7 @@ def genAliases(starnames):
 
     s = Simbad()
     s.add_votable_fields('ids')
-    baseurl = "https://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI"
+    baseurl = ipacbaseurl
 
     ids = []
     aliases = []
@@ -1277,6 +2421,83 @@ def fillMissingAliases(engine,data):
     return genAliases(missing)
 
 
+#columns of KnownPlanets feeding the quadrature, orbit and completeness calculations
+planetinputcols = ['pl_name','pl_hostname','pl_orbsmax','pl_orbsmaxerr1','pl_orbsmaxerr2','pl_orbeccen',
+                   'pl_orbeccenerr1','pl_orbeccenerr2','pl_orbincl','pl_orbinclerr1','pl_orbinclerr2','pl_orblper',
+                   'pl_orblpererr1','pl_orblpererr2','pl_orbtper','pl_orbper','pl_bmassj','pl_bmassjerr1',
+                   'pl_bmassjerr2','pl_bmassprov','pl_radj','pl_radjerr1','pl_radjerr2','pl_radreflink',
+                   'pl_radj_forecastermod','pl_minangsep','pl_maxangsep','st_dist','st_mass','st_metfe','st_lum']
+
+
+def hashPlanetInputs(data, cols=None):
+    """ Return a hash of the input columns (default planetinputcols) of every planet
+    in data as a Series indexed by planet name.
+    """
+
+    if cols is None:
+        cols = planetinputcols
+
+    return pandas.Series(pandas.util.hash_pandas_object(data[cols], index=False).values,
+                         index=data['pl_name'].values)
+
+
+def findChangedPlanets(data, prevdata, cols=None):
+    """ Compare the inputs (default planetinputcols) of every planet in data (output of
+    getIPACdata) with those of a previous snapshot prevdata.  Returns a boolean array
+    that is True for planets that are new or whose inputs changed.  Everything is
+    flagged if there is no previous snapshot or it lacks any of the input columns.
+    """
+
+    if cols is None:
+        cols = planetinputcols
+
+    if (prevdata is None) or np.any([c not in prevdata.columns for c in cols]):
+        return np.ones(len(data), dtype=bool)
+
+    new = hashPlanetInputs(data, cols)
+    old = hashPlanetInputs(prevdata, cols)
+    changed = ~pandas.MultiIndex.from_arrays([new.index, new.values]).isin(
+                pandas.MultiIndex.from_arrays([old.index, old.values]))
+
+    return changed
+
+
+def mergeCachedPlanets(data, changed, newdata, prevdata):
+    """ Assemble the full planet table after running the pipeline stages on the
+    changed subset only.  Planets flagged in changed take their rows from newdata,
+    the rest keep their current data rows with all derived columns (those in prevdata
+    but not data) carried over from prevdata.
+    """
+
+    derived = [c for c in prevdata.columns if c not in data.columns]
+    olddata = data[~changed].merge(prevdata[['pl_name']+derived], on='pl_name', how='left')
+    out = pandas.concat([newdata, olddata], ignore_index=True, sort=False)
+
+    return out.sort_values(by=['pl_name'], kind='mergesort').reset_index(drop=True)
+
+
+def mergeCachedRows(newrows, prevrows, keepnames, key='Name'):
+    """ Merge the rows of a previous stage output (prevrows) belonging to names in
+    keepnames (matched on column key) with freshly computed rows newrows.
+
+    The index of both (e.g. the sample number of each planet in PlanetOrbits) is
+    kept, and rows are ordered by key (and by Epoch first, if there is one) and
+    then index, as in a full build.
+    """
+
+    if prevrows is None:
+        return newrows
+    oldrows = prevrows[prevrows[key].isin(keepnames)]
+    if newrows is None:
+        return oldrows
+
+    out = pandas.concat([newrows, oldrows], sort=False)
+    name = out.index.name
+    by = [c for c in ['Epoch'] if c in out.columns] + [key, '_row']
+
+    return out.rename_axis('_row').sort_values(by=by, kind='mergesort').rename_axis(name)
+
+
 def writeSQL(engine,data=None,orbdata=None,altorbdata=None,comps=None,aliases=None):
     """write outputs to sql database via engine"""
 
@@ -167,7 +167,7 @@ if ($resultp){
         echo '<div id="plot2Div" style="width:500px; height:500px; float:left;"></div>';
         echo "\n\n";
         echo "<script>\n";
-        echo "var xsize = 100, x = new Array(xsize), r = new Array(xsize), WA = new Array(xsize); \n";
+        echo "var xsize = ".$resultp->num_rows.", x = new Array(xsize), r = new Array(xsize), WA = new Array(xsize); \n";
         
         $clouds = array("000C","001C","003C","010C","030C","100C","300C","600C","min","max","med");
         $bands = array("575","660","730","760","825");
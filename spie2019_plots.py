@@ -216,9 +216,7 @@ row = data.iloc[inds[0]]
 
 
 (l,band,bw,ws,wstep) = list(bandzip)[0]
-photinterps2 = photdict['photinterps']
-feinterp = photdict['feinterp']
-distinterp = photdict['distinterp']
+photmodel = PhotometryModel(photdict, bandzip)
 
 wfirstcontr = np.genfromtxt('WFIRST_pred_imaging.txt')
 contr = wfirstcontr[:,1]
@@ -259,7 +257,8 @@ gena = lambda n: np.clip(np.random.randn(n)*astd + amu,0,np.inf)
 #eccentricity distribution
 emu = row['pl_orbeccen'] 
 if np.isnan(emu):
-    gene = lambda n: 0.175/np.sqrt(np.pi/2.)*np.sqrt(-2.*np.log(1 - np.random.uniform(size=n)))
+    #Rayleigh, clipped like the known eccentricity draws as keplerSolve needs e < 1
+    gene = lambda n: np.clip(0.175/np.sqrt(np.pi/2.)*np.sqrt(-2.*np.log(1 - np.random.uniform(size=n))),0,0.99)
 else:
     estd = (row['pl_orbeccenerr1'] - row['pl_orbeccenerr2'])/2.
     if np.isnan(estd) or (estd == 0):
@@ -361,12 +360,11 @@ def calcplancomp(t0in = None):
         else:
             #M0 = np.mod((t0in - tau)*nmm,2*np.pi)
             M0 = t0in/Tp*2*np.pi
-        E = eccanom(M0, e)
-        nu = 2*np.arctan(np.sqrt((1+e)/(1-e))*np.tan(E/2))
+        E, nu = keplerSolve(M0, e, trueanom=True)
 
         d = a * (1.0 - e ** 2.0) / (1 + e * np.cos(nu))
-        s = d * np.sqrt(4.0 * np.cos(2 * I) + 4 * np.cos(2 * nu + 2.0 * w) - 2.0 * np.cos(-2 * I + 2.0 * nu + 2 * w) - 2 * np.cos(2 * I + 2 * nu + 2 * w) + 12.0) / 4.0
-        beta = np.arccos(np.sin(I) * np.sin(nu + w)) * u.rad
+        s = projectedSeparation(d, I, nu, w)
+        beta = phaseAngle(-I, nu, w, deg=True) #line of sight along +z in this script
         rnorm = d
 
         lum = row['st_lum']
@@ -376,19 +374,11 @@ def calcplancomp(t0in = None):
         else:
             lum_fix = (10 ** lum) ** .5  # Since lum is log base 10 of solar luminosity
 
-        pphi = np.zeros(n)
-        for clevel in np.unique(cl):
-            tmpinds = cl == clevel
-            betatmp = beta[tmpinds]
-            binds = np.argsort(betatmp)
-            pphi[tmpinds] = (photinterps2[float(feinterp(fe))][float(distinterp(np.mean(rnorm) / lum_fix))][clevel](betatmp.to(u.deg).value[binds],ws).sum(1)*wstep/bw)[np.argsort(binds)].flatten()
-
-
-        pphi[np.isinf(pphi)] = np.nan 
+        pphi = photmodel(fe, np.mean(rnorm) / lum_fix, cl, beta)
         pphi[pphi <= 0.0] = 1e-16
 
-        dMag = deltaMag(1, R*u.R_jupiter, rnorm*u.AU, pphi)
-        WA = np.arctan((s*u.AU)/(row['st_dist']*u.pc)).to('mas').value # working angle
+        dMag = deltaMagnitude(R, rnorm, pphi)
+        WA = workingAngle(s, row['st_dist']) # working angle
 
         h += np.histogram2d(WA,dMag,bins=(WAbins,dMagbins))[0][1:-1,0:-1]
         k += 1.0
@@ -494,8 +484,7 @@ w = wmu
 Mp0 = ((row['pl_bmassj']*u.M_jupiter).to(u.M_earth)).value
 Tp = Tmu
 M0 = ts[43]/Tp*2*np.pi
-E = eccanom(M0, e)
-nu = 2*np.arctan(np.sqrt((1+e)/(1-e))*np.tan(E/2))
+E, nu = keplerSolve(M0, e, trueanom=True)
 d = a * (1.0 - e ** 2.0) / (1 + e * np.cos(nu))
 
 while (pdiff > 0.0001) | (k <3):
@@ -512,8 +501,8 @@ while (pdiff > 0.0001) | (k <3):
     R = (RfromM(Mp)*u.R_earth).to(u.R_jupiter).value
     R[R > 1.0] = 1.0
 
-    s = d * np.sqrt(4.0 * np.cos(2 * I) + 4 * np.cos(2 * nu + 2.0 * w) - 2.0 * np.cos(-2 * I + 2.0 * nu + 2 * w) - 2 * np.cos(2 * I + 2 * nu + 2 * w) + 12.0) / 4.0
-    beta = np.arccos(np.sin(I) * np.sin(nu + w)) * u.rad
+    s = projectedSeparation(d, I, nu, w)
+    beta = phaseAngle(-I, nu, w, deg=True) #line of sight along +z in this script
     rnorm = d
 
     lum = row['st_lum']
@@ -523,19 +512,11 @@ while (pdiff > 0.0001) | (k <3):
     else:
         lum_fix = (10 ** lum) ** .5  # Since lum is log base 10 of solar luminosity
 
-    pphi = np.zeros(n)
-    for clevel in np.unique(cl):
-        tmpinds = cl == clevel
-        betatmp = beta[tmpinds]
-        binds = np.argsort(betatmp)
-        pphi[tmpinds] = (photinterps2[float(feinterp(fe))][float(distinterp(np.mean(rnorm) / lum_fix))][clevel](betatmp.to(u.deg).value[binds],ws).sum(1)*wstep/bw)[np.argsort(binds)].flatten()
-
-
-    pphi[np.isinf(pphi)] = np.nan 
+    pphi = photmodel(fe, np.mean(rnorm) / lum_fix, cl, beta)
     pphi[pphi <= 0.0] = 1e-16
 
-    dMag = deltaMag(1, R*u.R_jupiter, rnorm*u.AU, pphi)
-    WA = np.arctan((s*u.AU)/(row['st_dist']*u.pc)).to('mas').value # working angle
+    dMag = deltaMagnitude(R, rnorm, pphi)
+    WA = workingAngle(s, row['st_dist']) # working angle
 
     h += np.histogram2d(WA,dMag,bins=(WAbins,dMagbins))[0][1:-1,0:-1]
     k += 1.0
@@ -0,0 +1,76 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+import pandas
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import savePhotometryData, loadPhotometryData, genBands
+
+
+@pytest.fixture(scope='session')
+def photfile(tmp_path_factory):
+    """small synthetic photometry grid saved in the .npy/.json format"""
+
+    metallicities = np.array([0., 0.5])
+    dists = np.array([0.5, 1., 5.])
+    clouds = np.array([0., 1., 3.])
+    cloudstr = np.array(['000', '100', '300'])
+    betas = np.arange(0., 181., 10.)
+    wavelns = np.arange(0.4, 1.0001, 0.01)
+
+    #Lambert phase function scaled by smooth metallicity/distance/cloud/wavelength terms
+    b = np.radians(betas)
+    phase = (np.sin(b) + (np.pi - b)*np.cos(b))/np.pi
+    allphotdata = 0.3*phase[None,None,None,:,None] \
+        * (1 + 0.1*metallicities)[:,None,None,None,None] \
+        * (1 + 0.05*np.log(dists))[None,:,None,None,None] \
+        * (1 + 0.1*clouds)[None,None,:,None,None] \
+        * (1 - 0.2*(wavelns - 0.7))[None,None,None,None,:]
+
+    outname = str(tmp_path_factory.mktemp('phot').joinpath('testphot'))
+    savePhotometryData(outname, metallicities, dists, clouds, cloudstr, betas, wavelns, allphotdata)
+
+    return outname + '.npy'
+
+
+@pytest.fixture(scope='session')
+def photdict(photfile):
+    return loadPhotometryData(photfile, cachedir=False)
+
+
+@pytest.fixture(scope='session')
+def bandzip():
+    return list(genBands())
+
+
+@pytest.fixture
+def makePlanets():
+    """factory for planet tables with the columns of getIPACdata used by the stages"""
+
+    def makePlanets(names, **cols):
+        n = len(names)
+        nan = np.full(n, np.nan)
+        data = {'pl_name': names,
+                'pl_hostname': [name.rsplit(' ', 1)[0] for name in names],
+                'pl_orbsmax': np.full(n, 1.), 'pl_orbsmaxerr1': nan, 'pl_orbsmaxerr2': nan,
+                'pl_orbeccen': nan, 'pl_orbeccenerr1': nan, 'pl_orbeccenerr2': nan,
+                'pl_orbincl': nan, 'pl_orbinclerr1': nan, 'pl_orbinclerr2': nan,
+                'pl_orblper': nan, 'pl_orblpererr1': nan, 'pl_orblpererr2': nan,
+                'pl_orbtper': nan, 'pl_orbper': np.full(n, 365.25),
+                'pl_bmassj': np.full(n, 1.), 'pl_bmassjerr1': nan, 'pl_bmassjerr2': nan,
+                'pl_bmassprov': np.full(n, 'Mass', dtype=object),
+                'pl_radj': np.full(n, 1.), 'pl_radjerr1': nan, 'pl_radjerr2': nan,
+                'pl_radreflink': np.full(n, '', dtype=object),
+                'pl_radj_forecastermod': np.full(n, 1.),
+                'pl_minangsep': np.full(n, 50.), 'pl_maxangsep': np.full(n, 300.),
+                'st_dist': np.full(n, 10.), 'st_mass': np.full(n, 1.), 'st_lum': np.full(n, 0.),
+                'st_metfe': np.full(n, 0.)}
+        for k,v in cols.items():
+            data[k] = np.broadcast_to(v, (n,)).copy()
+
+        return pandas.DataFrame(data)
+
+    return makePlanets
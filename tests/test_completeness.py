@@ -0,0 +1,44 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import calcPlanetCompleteness, findChangedPlanets, mergeCachedPlanets, mergeCachedRows
+
+compcols = ['completeness', 'compMinWA', 'compMaxWA', 'compMindMag', 'compMaxdMag']
+
+
+def test_incremental_none_in_range(tmp_path, makePlanets, photdict, bandzip):
+    contrfile = str(tmp_path.joinpath('contr.txt'))
+    np.savetxt(contrfile, np.vstack((np.linspace(2, 10, 9), np.full(9, 1e-9))).T)
+
+    prevdata = makePlanets(['a b', 'c b'])
+    prevdata = prevdata.assign(completeness=[0.2, 0.1], compMinWA=[150., 160.], compMaxWA=[300., 310.],
+                               compMindMag=[18., 19.], compMaxdMag=[22., 23.])
+    prevcomps = pandas.DataFrame({'Name': ['a b', 'a b', 'c b'], 'alpha': [150.5, 151.5, 160.5],
+                                  'dMag': [18.05, 18.05, 19.05], 'H': [-3., -4., -3.5],
+                                  'iind': [0, 1, 10], 'jind': [180, 180, 190]})
+
+    #c b moved well inside the inner working angle
+    data = makePlanets(['a b', 'c b'], pl_minangsep=[50., 5.], pl_maxangsep=[300., 20.])
+    changed = findChangedPlanets(data, prevdata)
+    assert changed.tolist() == [False, True]
+    keepnames = data['pl_name'].values[~changed]
+    newdata = data[changed].reset_index(drop=True)
+
+    comps, compdict, newdata = calcPlanetCompleteness(newdata, bandzip, photdict, contrfile=contrfile)
+    assert list(comps.columns) == ['Name', 'alpha', 'dMag', 'H', 'iind', 'jind']
+    assert len(comps) == 0
+    assert len(compdict['goodinds']) == 0
+    assert np.all(np.isnan(newdata[compcols].values))
+
+    comps = mergeCachedRows(comps, prevcomps, keepnames)
+    pandas.testing.assert_frame_equal(comps, prevcomps.iloc[:2])
+
+    out = mergeCachedPlanets(data, changed, newdata, prevdata)
+    assert out['pl_name'].tolist() == ['a b', 'c b']
+    assert np.all(out[compcols].values[0] == prevdata[compcols].values[0])
+    assert np.all(np.isnan(out[compcols].values[1]))
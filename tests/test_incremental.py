@@ -0,0 +1,63 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import findChangedPlanets, mergeCachedPlanets, mergeCachedRows
+
+cols = ['pl_name', 'pl_orbsmax']
+
+
+def genPlanets(names, smas):
+    return pandas.DataFrame({'pl_name': names, 'pl_orbsmax': smas}).sort_values(
+        by=['pl_name']).reset_index(drop=True)
+
+
+def genDerived(data):
+    """stand-in for the stages adding columns to the planet table"""
+    return data.assign(quad=2*data['pl_orbsmax'].values)
+
+
+def genRows(data):
+    """stand-in for genOrbitData: a varying number of rows per planet, indexed by sample"""
+    counts = np.ceil(data['pl_orbsmax'].values).astype(int) + 1
+    plan = np.repeat(np.arange(len(data)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return pandas.DataFrame({'Name': data['pl_name'].values[plan],
+                             'M': data['pl_orbsmax'].values[plan]*k}, index=k)
+
+
+def build(data, prevdata=None, prevrows=None):
+    """the gen_plandb sequence: only new or changed planets are recomputed"""
+    changed = findChangedPlanets(data, prevdata, cols=cols)
+    keepnames = data['pl_name'].values[~changed]
+    newdata = genDerived(data[changed].reset_index(drop=True))
+    rows = mergeCachedRows(genRows(newdata) if len(newdata) > 0 else None, prevrows, keepnames)
+    if prevdata is not None:
+        newdata = mergeCachedPlanets(data, changed, newdata, prevdata)
+    return newdata, rows
+
+
+def test_incremental_matches_full():
+    data1 = genPlanets(['a b', 'c b', 'e b', 'g b'], [1.5, 0.3, 4.2, 2.0])
+    #c b changed, e b removed, d b and h b new
+    data2 = genPlanets(['a b', 'c b', 'd b', 'g b', 'h b'], [1.5, 2.7, 0.9, 2.0, 3.1])
+
+    prevdata, prevrows = build(data1)
+    fulldata, fullrows = build(data2)
+    incdata, incrows = build(data2, prevdata, prevrows)
+
+    pandas.testing.assert_frame_equal(incdata, fulldata)
+    pandas.testing.assert_frame_equal(incrows, fullrows)
+
+
+def test_nothing_changed():
+    data = genPlanets(['a b', 'c b'], [1.5, 0.3])
+    prevdata, prevrows = build(data)
+    incdata, incrows = build(data, prevdata, prevrows)
+
+    pandas.testing.assert_frame_equal(incdata, prevdata)
+    pandas.testing.assert_frame_equal(incrows, prevrows)
@@ -0,0 +1,303 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import gzip
+import threading
+import numpy as np
+import pandas
+import pytest
+import requests
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    pytest.skip("needs python 3", allow_module_level=True)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import genIPACquery, cacheIPACquery, readIPACquery, fetchIPACqueries, getIPACdata, \
+    ipacschemas, ipacbaseurl
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """answers with the route of the requested table, logging every request"""
+
+    def do_GET(self):
+        q = {k:v[0] for k,v in parse_qs(urlparse(self.path).query).items()}
+        self.server.log.append((q['table'], q, dict(self.headers)))
+        status, headers, body = self.server.routes[q['table']](q, self.headers)
+        self.send_response(status)
+        for k,v in headers.items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def archive():
+    """stand-in for the archive API on localhost, with routes to fill in by table"""
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    server.routes = {}
+    server.log = []
+    server.baseurl = 'http://127.0.0.1:%d/nph-nstedAPI'%server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def static(body, etag=None, lastmod=None):
+    """route serving body, honoring If-None-Match/If-Modified-Since"""
+
+    def route(q, headers):
+        out = {}
+        if etag:
+            out['ETag'] = etag
+        if lastmod:
+            out['Last-Modified'] = lastmod
+        if (etag and headers.get('If-None-Match') == etag) or \
+                (lastmod and headers.get('If-Modified-Since') == lastmod):
+            return 304, out, b''
+        return 200, out, body
+
+    return route
+
+
+def failing(statuses, body):
+    """route answering with each of statuses in turn, then serving body"""
+
+    statuses = list(statuses)
+
+    def route(q, headers):
+        if statuses:
+            return statuses.pop(0), {}, b'server error'
+        return 200, {}, body
+
+    return route
+
+
+csv1 = b'pl_name,pl_orbsmax,pl_letter\nAaa b,1.5,b\nBbb c,0.3,c\n'
+csv2 = b'pl_name,pl_orbsmax,pl_letter\nAaa b,1.6,b\nBbb c,0.3,c\n'
+
+
+def test_query_builder():
+    q = genIPACquery('exoplanets', select=['pl_name','pl_orbsmax'], where='pl_status<>0 or pl_status is null')
+    assert q.startswith(ipacbaseurl+'?')
+    assert parse_qs(urlparse(q).query) == {'table': ['exoplanets'], 'select': ['pl_name,pl_orbsmax'],
+                                           'where': ['pl_status<>0 or pl_status is null'],
+                                           'format': ['csv']}
+
+    q = genIPACquery('exomultpars', baseurl='http://localhost/api')
+    assert q.startswith('http://localhost/api?')
+    assert parse_qs(urlparse(q).query) == {'table': ['exomultpars'], 'select': ['*'], 'format': ['csv']}
+
+
+def test_cache_etag(archive, tmp_path):
+    archive.routes['exoplanets'] = static(csv1, etag='"v1"', lastmod='Mon, 01 Jan 2018 00:00:00 GMT')
+    q = genIPACquery('exoplanets', baseurl=archive.baseurl)
+
+    csvfile, meta = cacheIPACquery(q, cachedir=str(tmp_path))
+    with gzip.open(csvfile, 'rb') as f:
+        assert f.read() == csv1
+    assert meta['etag'] == '"v1"'
+    assert 'If-None-Match' not in archive.log[-1][2]
+
+    #revalidated and kept on 304
+    csvfile2, meta2 = cacheIPACquery(q, cachedir=str(tmp_path))
+    assert (csvfile2, meta2) == (csvfile, meta)
+    assert archive.log[-1][2]['If-None-Match'] == '"v1"'
+    assert archive.log[-1][2]['If-Modified-Since'] == 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    #new version
+    archive.routes['exoplanets'] = static(csv2, etag='"v2"')
+    csvfile3, meta3 = cacheIPACquery(q, cachedir=str(tmp_path))
+    with gzip.open(csvfile3, 'rb') as f:
+        assert f.read() == csv2
+    assert meta3['etag'] == '"v2"'
+    assert meta3['sha256'] != meta['sha256']
+
+
+def test_cache_no_headers(archive, tmp_path):
+    archive.routes['exoplanets'] = static(csv1)
+    q = genIPACquery('exoplanets', baseurl=archive.baseurl)
+
+    csvfile, meta = cacheIPACquery(q, cachedir=str(tmp_path))
+    assert (meta['etag'] is None) and (meta['last_modified'] is None)
+
+    #downloaded again, but recognized as unchanged by its hash
+    mtime = os.stat(csvfile).st_mtime_ns
+    csvfile2, meta2 = cacheIPACquery(q, cachedir=str(tmp_path))
+    assert len(archive.log) == 2
+    assert 'If-None-Match' not in archive.log[-1][2]
+    assert meta2['sha256'] == meta['sha256']
+    assert os.stat(csvfile2).st_mtime_ns == mtime
+    assert not os.path.exists(csvfile+'.tmp')
+
+    archive.routes['exoplanets'] = static(csv2)
+    csvfile3, meta3 = cacheIPACquery(q, cachedir=str(tmp_path))
+    assert meta3['sha256'] != meta['sha256']
+    with gzip.open(csvfile3, 'rb') as f:
+        assert f.read() == csv2
+
+
+def test_cache_offline(archive, tmp_path):
+    archive.routes['exoplanets'] = static(csv1, etag='"v1"')
+    q = genIPACquery('exoplanets', baseurl=archive.baseurl)
+
+    with pytest.raises(IOError):
+        cacheIPACquery(q, cachedir=str(tmp_path), offline=True)
+    assert len(archive.log) == 0
+
+    csvfile, meta = cacheIPACquery(q, cachedir=str(tmp_path))
+    assert cacheIPACquery(q, cachedir=str(tmp_path), offline=True) == (csvfile, meta)
+    assert len(archive.log) == 1
+
+
+def test_cache_errors(archive, tmp_path):
+    archive.routes['exoplanets'] = static(b'ERROR<br>\nError Type: UserError<br>\nMessage: bad column\n')
+    archive.routes['exomultpars'] = failing([500], csv1)
+    q = genIPACquery('exoplanets', select=['nosuchcol'], baseurl=archive.baseurl)
+
+    with pytest.raises(IOError, match='bad column'):
+        cacheIPACquery(q, cachedir=str(tmp_path))
+    with pytest.raises(requests.exceptions.HTTPError):
+        cacheIPACquery(genIPACquery('exomultpars', baseurl=archive.baseurl), cachedir=str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def listPickles(path):
+    """parsed copies in cache directory path"""
+    return [f for f in os.listdir(str(path)) if f.endswith('.pkl')]
+
+
+def test_read_schema(archive, tmp_path):
+    archive.routes['exoplanets'] = static(csv1, etag='"v1"')
+    q = genIPACquery('exoplanets', baseurl=archive.baseurl)
+    schema = {'pl_name': 'object', 'pl_orbsmax': 'float32', 'pl_radj': 'float64'}
+
+    data = readIPACquery(q, cachedir=str(tmp_path), schema=schema)
+    assert list(data.columns) == ['pl_name', 'pl_orbsmax']
+    assert data['pl_orbsmax'].dtype == np.float32
+    assert len(listPickles(tmp_path)) == 1
+
+    #304, reusing the parsed copy
+    data2 = readIPACquery(q, cachedir=str(tmp_path), schema=schema)
+    pandas.testing.assert_frame_equal(data2, data)
+    assert len(listPickles(tmp_path)) == 1
+
+    #all columns
+    data3 = readIPACquery(q, cachedir=str(tmp_path), offline=True)
+    assert list(data3.columns) == ['pl_name', 'pl_orbsmax', 'pl_letter']
+
+    #new content replaces the parsed copies
+    archive.routes['exoplanets'] = static(csv2, etag='"v2"')
+    data4 = readIPACquery(q, cachedir=str(tmp_path), schema=schema)
+    assert data4['pl_orbsmax'].values[0] == np.float32(1.6)
+    assert len(listPickles(tmp_path)) == 1
+
+
+def test_fetch_retry(archive, tmp_path):
+    archive.routes['exoplanets'] = failing([503, 502], csv1)
+    archive.routes['exomultpars'] = static(csv2)
+    queries = {'exoplanets': genIPACquery('exoplanets', baseurl=archive.baseurl),
+               'exomultpars': genIPACquery('exomultpars', baseurl=archive.baseurl)}
+
+    tables = fetchIPACqueries(queries, cachedir=str(tmp_path), retries=2, backoff=0.01)
+    assert sorted(tables.keys()) == ['exomultpars', 'exoplanets']
+    assert tables['exoplanets']['pl_orbsmax'].tolist() == [1.5, 0.3]
+    assert tables['exomultpars']['pl_orbsmax'].tolist() == [1.6, 0.3]
+    assert [t for t,q,h in archive.log].count('exoplanets') == 3
+
+    #offline from the cache
+    tables2 = fetchIPACqueries(queries, cachedir=str(tmp_path), offline=True)
+    pandas.testing.assert_frame_equal(tables2['exoplanets'], tables['exoplanets'])
+    assert len(archive.log) == 4
+
+
+def test_fetch_retry_fails(archive, tmp_path):
+    archive.routes['exoplanets'] = failing([500]*10, csv1)
+    archive.routes['exomultpars'] = failing([404], csv1)
+    q1 = {'exoplanets': genIPACquery('exoplanets', baseurl=archive.baseurl)}
+    q2 = {'exomultpars': genIPACquery('exomultpars', baseurl=archive.baseurl)}
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        fetchIPACqueries(q1, cachedir=str(tmp_path), retries=1, backoff=0.01)
+    assert len(archive.log) == 2
+
+    #client errors are not retried
+    with pytest.raises(requests.exceptions.HTTPError):
+        fetchIPACqueries(q2, cachedir=str(tmp_path), retries=3, backoff=0.01)
+    assert len(archive.log) == 3
+
+
+def genTables():
+    """archive tables of two usable planets and a retracted one"""
+
+    def table(name, rows):
+        cols = sorted(ipacschemas[name])
+        return pandas.DataFrame([{c:row.get(c, np.nan) for c in cols} for row in rows], columns=cols)
+
+    calc = '<a refstr=CALCULATED_VALUE href=/docs/composite_calc.html target=_blank>Calculated Value</a>'
+    star = {'st_dist': 10., 'st_disterr1': 0.1, 'st_disterr2': -0.1, 'st_mass': 1., 'st_lum': 0.,
+            'st_teff': 5800., 'st_metfe': 0.}
+    names = ['Aaa b', 'Bbb b', 'Ccc b']
+
+    composite = table('compositepars', [dict([('fpl_name', n), ('fpl_radj', r), ('fpl_radreflink', l)] +
+                                             [('f'+k.replace('metfe', 'met'), v) for k,v in star.items()])
+                                        for n,r,l in zip(names, [1.1, np.nan, 1.], ['', calc, ''])])
+    planets = table('exoplanets', [dict([('pl_name', n), ('pl_hostname', n[:-2]), ('pl_letter', 'b'),
+                                         ('pl_status', s), ('pl_orbsmax', 1.), ('pl_orbper', 365.),
+                                         ('pl_bmassj', 1.), ('pl_bmassprov', 'Mass')] + list(star.items()))
+                                   for n,s in zip(names, [1, 1, 0])])
+    ext = table('exomultpars', [{'mpl_name': n, 'mpl_def': 1, 'mpl_orbsmax': 1.2, 'mpl_orbper': 400.,
+                                 'mpl_orbeccen': 0.1, 'mpl_bmassj': m, 'mpl_bmassjerr1': 0.1, 'mpl_bmassjerr2': -0.1,
+                                 'mpl_bmassprov': 'Mass', 'mst_mass': 1.,
+                                 'mpl_reflink': '<a refstr=SMITH_ET_AL__2010 href=/ref target=ref>Smith et al. 2010</a>'}
+                                for n,m in zip(names, [1., 2., 3.])])
+
+    return {'compositepars': composite, 'exoplanets': planets, 'exomultpars': ext}
+
+
+def test_getIPACdata(archive, tmp_path):
+    tables = genTables()
+
+    def serve(name):
+        def route(q, headers):
+            out = tables[name]
+            #the archive side of the where clause pushed down by getIPACdata
+            if q.get('where') == 'pl_status<>0 or pl_status is null':
+                out = out[out['pl_status'] != 0]
+            return 200, {'ETag': '"%s"'%name}, out[q['select'].split(',')].to_csv(index=False).encode('utf-8')
+        return route
+    for name in tables:
+        archive.routes[name] = serve(name)
+
+    data = getIPACdata(cachedir=str(tmp_path), baseurl=archive.baseurl, seed=0)
+    reqs = {t:q for t,q,h in archive.log}
+    assert sorted(reqs.keys()) == sorted(ipacschemas.keys())
+    for name in ipacschemas:
+        assert reqs[name]['select'].split(',') == sorted(ipacschemas[name])
+    assert reqs['exoplanets']['where'] == 'pl_status<>0 or pl_status is null'
+
+    assert data['pl_name'].tolist() == ['Aaa b', 'Bbb b']
+    assert data['pl_orbsmax'].tolist() == [1.2, 1.2]
+    assert data['pl_bmassj'].tolist() == [1., 2.]
+    assert data['pl_calc_rad'].tolist() == [0, 1]
+    assert data['pl_radj_forecastermod'].values[0] == 1.1
+    assert np.isfinite(data['pl_radj_forecastermod'].values[1])
+    assert np.isfinite(data['pl_radj_forecastermoderr1'].values[1])
+
+    #offline, from the cache
+    nreq = len(archive.log)
+    data2 = getIPACdata(cachedir=str(tmp_path), offline=True, baseurl=archive.baseurl, seed=0)
+    assert len(archive.log) == nreq
+    pandas.testing.assert_frame_equal(data2, data)
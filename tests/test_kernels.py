@@ -0,0 +1,42 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_kernels import workingAngle, projectedSeparation, keplerSolve
+
+
+def test_output_dtype():
+    s32 = np.array([1., 2.], dtype=np.float32)
+    d32 = np.array([10., 20.], dtype=np.float32)
+
+    assert workingAngle(1.0, 10.0).dtype == np.float64
+    assert workingAngle(np.float32(1.0), np.float32(10.0)).dtype == np.float64
+    assert workingAngle(s32, 10.0).dtype == np.float32
+    assert workingAngle(s32, d32).dtype == np.float32
+    assert workingAngle(s32, np.array([10., 20.])).dtype == np.float64
+    assert workingAngle(np.array([1, 2]), 10.0).dtype == np.float64
+    assert workingAngle(s32, d32, dtype=np.float64).dtype == np.float64
+    assert projectedSeparation(s32, np.pi/3, 1.0, 0.5).dtype == np.float32
+
+    assert np.allclose(workingAngle(s32, d32), workingAngle(s32.astype(float), d32.astype(float)), rtol=1e-6)
+
+
+def test_kepler_scalar():
+    M = np.linspace(-10, 10, 41)
+    for e in [0., 0.5, 0.95]:
+        E, sinE, cosE, nu = keplerSolve(M, e, sincos=True, trueanom=True)
+        for j in range(M.size):
+            res = keplerSolve(M[j], e, sincos=True, trueanom=True)
+            assert all(np.ndim(r) == 0 and r.dtype == np.float64 for r in res)
+            assert res == (E[j], sinE[j], cosE[j], nu[j])
+
+    E = keplerSolve(1.0, 0.3)
+    assert np.ndim(E) == 0
+    assert abs(E - 0.3*np.sin(E) - 1.0) < 1e-15
+
+    out = np.empty(())
+    assert keplerSolve(1.0, 0.3, out=out) is out
+    assert out == E
@@ -0,0 +1,46 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import savePhotometryData, hashPhotometryGrid, loadPhotometryData
+
+
+def saveGrid(outname, allphotdata):
+    savePhotometryData(outname, [0.], [1.], [0., 1.], ['000', '100'], [0., 90., 180.], [0.5, 0.6, 0.7],
+                       allphotdata)
+    return outname + '.npy'
+
+
+def test_grid_hash(tmp_path):
+    vals = np.linspace(0.1, 0.3, 18).reshape(1, 1, 2, 3, 3)
+    infile = saveGrid(str(tmp_path.joinpath('grid')), vals)
+    h = hashPhotometryGrid(infile)
+
+    #the grid is identified by the hash in the sidecar, not the file itself
+    with open(str(tmp_path.joinpath('grid.json'))) as f:
+        assert len(json.load(f)['sha1']) == 40
+    with open(infile, 'r+b') as f:
+        f.seek(-8, os.SEEK_END)
+        f.write(b'\0'*8)
+    assert hashPhotometryGrid(infile) == h
+
+    #rewriting the same data keeps the hash, new data changes it
+    assert hashPhotometryGrid(saveGrid(str(tmp_path.joinpath('grid')), vals)) == h
+    assert hashPhotometryGrid(saveGrid(str(tmp_path.joinpath('grid')), 2*vals)) != h
+
+    photdict = loadPhotometryData(infile, cachedir=str(tmp_path.joinpath('cache')))
+    assert photdict['cachedir'] == str(tmp_path.joinpath('cache', hashPhotometryGrid(infile)))
+
+
+def test_grid_hash_npz(tmp_path):
+    infile = str(tmp_path.joinpath('grid.npz'))
+    np.savez(infile, allphotdata=np.ones((1, 1, 2, 3, 3)))
+    h = hashPhotometryGrid(infile)
+    assert hashPhotometryGrid(infile) == h
+
+    np.savez(infile, allphotdata=np.ones((1, 1, 2, 3, 4)))
+    assert hashPhotometryGrid(infile) != h
@@ -0,0 +1,34 @@
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from plandb_methods import linearUncertainty, propagateUncertainty, RfromM, dRdM, RfromMcoeffs
+
+
+def test_linearUncertainty_all_montecarlo():
+    """all relative errors above maxrelerr: nothing linearized, all done by Monte Carlo"""
+
+    m = np.array([1., 5., 50., 300.])
+    merr = 0.5*m
+    res = linearUncertainty(RfromM, [m], [merr], derivs=[dRdM], breaks=[RfromMcoeffs()[2]],
+                            nvalidate=2, seed=0)
+
+    assert res['mc'].all()
+    assert res['deviation'].size == 0
+    mcstd = propagateUncertainty(RfromM, [m], [merr], percentiles=(), seed=np.random.RandomState(0))['std']
+    assert np.allclose(res['std'], mcstd)
+
+
+def test_linearUncertainty_mixed():
+    """small errors away from breaks are linearized, large ones are not"""
+
+    m = np.array([1., 50., 50.])
+    merr = np.array([0.01, 0.5, 40.])
+    res = linearUncertainty(RfromM, [m], [merr], derivs=[dRdM], breaks=[RfromMcoeffs()[2]], seed=0)
+
+    assert list(res['mc']) == [False, False, True]
+    assert np.allclose(res['std'][:2], np.abs(dRdM(m[:2]))*merr[:2])
+    assert np.all(np.isfinite(res['std']))
@@ -1,4 +1,5 @@
-def crazyplot(name):
+def crazyplot(name, band=0):
+    """dMag and WA over time of planet name at each inclination, in bandzip[band]"""
     j = np.where(plannames == name)[0][0]
 
     f1,ax1 = plt.subplots()
@@ -48,14 +49,16 @@ def crazyplot(name):
     tplot = ttmp - t0.jd
 
 
-    E = eccanom(M, e)  
-    nu = 2*np.arctan(np.sqrt((1.0 + e)/(1.0 - e))*np.tan(E/2.0));
+    E, sinE, cosE, nu = keplerSolve(M, e, sincos=True, trueanom=True)
     d0 = a*(1.0 - e**2.0)/(1 + e*np.cos(nu))
 
     a1 = np.cos(w) 
     b1 = -np.sqrt(1 - e**2)*np.sin(w)
 
 
+    photmodel = PhotometryModel(photdict, bandzip)
+    l = bandzip[band][0]
+
     for k,I in enumerate(Is):
 
         a2 = np.cos(I)*np.sin(w)
@@ -65,25 +68,23 @@ def crazyplot(name):
         b2 = np.sqrt(1 - e**2)*np.cos(I)*np.cos(w)
         b3 = np.sqrt(1 - e**2)*np.sin(I)*np.cos(w)
         B = a*np.vstack((b1, b2, b3))
-        r1 = np.cos(E) - e
-        r2 = np.sin(E)
+        r1 = cosE - e
+        r2 = sinE
 
         r = (A*r1 + B*r2).T
         d = np.linalg.norm(r, axis=1)
         s = np.linalg.norm(r[:,0:2], axis=1)
         beta = np.arccos(r[:,2]/d)*u.rad
 
-        WA = np.arctan((s*u.AU)/(dist*u.pc)).to('mas').value
+        WA = workingAngle(s, dist)
 
         if I == Icrit:
             Itag = "crit"
         else:
             Itag = "%02d"%(Isglob[k])
 
-        inds = np.argsort(beta)
-        pphi = (photinterps2[float(feinterp(fe))][float(distinterp(a))][c](beta.to(u.deg).value[inds],ws).sum(1)*wstep/bw)[np.argsort(inds)]
-        pphi[np.isinf(pphi)] = np.nan
-        dMag = deltaMag(1, Rp*u.R_jupiter, d*u.AU, pphi)
+        pphi = photmodel(fe, a, c, beta.to(u.deg).value, band=band)
+        dMag = deltaMagnitude(Rp, d, pphi)
         dMag[np.isinf(dMag)] = np.nan
 
         ax1.plot(tplot,dMag,label='I = '+Itag)
@@ -98,10 +99,10 @@ def crazyplot(name):
     ax1.set_ylabel('Delta Mag')
     ax2.set_ylabel('Ang. Sep')
     ax1.set_xlim([tplot[0],tplot[-1]])
-    ax1.set_title(name)
+    ax1.set_title(name+' (%s nm)'%l)
 
     ax3.set_ylabel('Delta Mag')
     ax3.set_xlabel('Ang. Sep')
     ax3.legend()
-    ax3.set_title(name)
+    ax3.set_title(name+' (%s nm)'%l)
     